@@ -12,7 +12,7 @@ from yadacoin import TransactionFactory, Transaction, \
                     Input, Output, Block, BlockFactory, Config, Peers, \
                     Blockchain, BlockChainException, BU, TU, \
                     Graph, Mongo, InvalidTransactionException, \
-                    InvalidTransactionSignatureException, MiningPool
+                    InvalidTransactionSignatureException, MiningPool, MerkleTree
 from eccsnacks.curve25519 import scalarmult, scalarmult_base
 from pyfcm import FCMNotification
 from flask.views import View
@@ -226,6 +226,27 @@ class WalletView(View):
         }
         return json.dumps(wallet, indent=4)
 
+class MerkleProofView(View):
+    def dispatch_request(self):
+        # enough for a light wallet to check a transaction is in a block without downloading the block
+        txn_id = request.args.get('txn_id', '').replace(' ', '+')
+        # blocks are only indexed by hash, transaction_index gets us there without a scan
+        entry = Mongo.db.transaction_index.find_one({'id': txn_id})
+        res = Mongo.db.blocks.find_one({'hash': entry['hash']}, {'_id': 0}) if entry else None
+        if not res:
+            return json.dumps({'status': 'error', 'message': 'transaction not found'}), 404
+        block = Block.from_dict(res)
+        txn_hash = [x.hash for x in block.transactions if x.transaction_signature == txn_id][0]
+        merkle_tree = MerkleTree(block.get_transaction_hashes())
+        header = block.to_dict()
+        del header['transactions']
+        return json.dumps({
+            'txn_id': txn_id,
+            'txn_hash': txn_hash,
+            'block': header,
+            'proof': merkle_tree.get_proof(str(txn_hash))
+        }, indent=4)
+
 class FaucetView(View):
     def dispatch_request(self):
         address = request.args.get('address')
@@ -254,54 +275,61 @@ class RegisterView(View):
 
 class MiningPoolView(View):
     def dispatch_request(self):
-        if not hasattr(MiningPoolView, 'header'):
-            MiningPool.pool_init(Config.to_dict())
-            MiningPoolView.header = MiningPool.block_factory.header
-            MiningPoolView.special_min = MiningPool.block_factory.block.special_min
-            MiningPoolView.target = MiningPool.block_factory.block.target
-        else:
-            MiningPoolView.header = MiningPool.block_factory.header
-            MiningPoolView.special_min = MiningPool.block_factory.block.special_min
-            MiningPoolView.target = MiningPool.block_factory.block.target
-        if not hasattr(MiningPoolView, 'gen'):
-            MiningPoolView.gen = MiningPool.nonce_generator()
-        return json.dumps({
-            'nonces': next(MiningPoolView.gen),
-            'target': MiningPoolView.target,
-            'special_min': MiningPoolView.special_min,
-            'header': MiningPoolView.header
-        })
+        done = []
+        for item in request.args.get('done', '').split(','):
+            if item:
+                job_id, start_nonce = item.split(':')
+                done.append((int(job_id), int(start_nonce)))
+        return json.dumps(MiningPool.get_job(
+            request.args.get('address'),
+            request.args.get('hashrate'),
+            done
+        ))
 
 class MiningPoolSubmitView(View):
     def dispatch_request(self):
         try:
-            block = MiningPool.block_factory.block
-            block.target = MiningPool.block_factory.block.target
-            block.version = MiningPool.block_factory.block.version
-            block.special_min = MiningPoolView.special_min
+            block_factory = MiningPool.get_template(request.json.get('job_id'))
+            if not block_factory:
+                print 'stale share'
+                return 'stale'
+            address = request.json.get('address')
+            share_target = MiningPool.get_issued_share_target(block_factory, address, request.json.get('share_target'))
+            if int(request.json.get('hash'), 16) >= share_target and not block_factory.block.special_min:
+                print 'low difficulty share'
+                return 'low difficulty'
+            if not MiningPool.verify_share(block_factory, request.json.get('nonce'), request.json.get('hash')):
+                print 'share failed verification'
+                return ''
+
+            block = block_factory.block
             block.hash = request.json.get('hash')
             block.nonce = request.json.get('nonce')
-            block.signature = BU.generate_signature(block.hash)
-            try:
-                block.verify()
-            except:
-                print 'block failed verification'
-                return ''
+            block.signature = ''
+            is_block = int(block.target) > int(block.hash, 16) or block.special_min
+            if is_block:
+                block.signature = BU.generate_signature(block.hash)
+                try:
+                    block.verify()
+                except:
+                    print 'block failed verification'
+                    return ''
 
             # submit share
-            Mongo.db.shares.update({
-                'address': request.json.get('address'),
-                'index': block.index,
-                'hash': block.hash
-            },
-            {
-                'address': request.json.get('address'),
-                'index': block.index,
-                'hash': block.hash,
-                'block': block.to_dict()
-            }, upsert=True)
-
-            if int(block.target) > int(block.hash, 16) or block.special_min:
+            difficulty = MiningPool.get_share_difficulty(share_target)
+            res = MiningPool.save_share(block_factory, address, block.nonce, block.hash, difficulty)
+            if not res.get('updatedExisting'):
+                # running work total for the payout, resubmitted shares don't count twice
+                Mongo.db.share_totals.update({
+                    'index': block.index,
+                    'address': address
+                },
+                {
+                    '$inc': {'difficulty': difficulty}
+                }, upsert=True)
+            MiningPool.record_share(address)
+
+            if is_block:
                 # broadcast winning block
                 MiningPool.broadcast_block(block)
                 print 'block ok'
@@ -1,3 +1,9 @@
+import sys
+if __name__ == '__main__' and sys.argv[1:2] == ['serve']:
+    # requests are served on gevent, patch before anything imports socket or threading
+    # so Mongo calls yield to other requests instead of blocking the whole process
+    from gevent import monkey
+    monkey.patch_all()
 import socketio
 import socket
 import json
@@ -13,6 +19,9 @@ import subprocess
 import os
 import endpoints
 import multiprocessing
+import threading
+import Queue
+import urlparse
 from sys import exit
 from multiprocessing import Process, Value, Array, Pool
 from socketIO_client import SocketIO, BaseNamespace
@@ -23,8 +32,9 @@ from yadacoin import TransactionFactory, Transaction, \
                     Input, Output, Block, Config, Peers, \
                     Blockchain, BlockChainException, TU, BU, \
                     Mongo, BlockFactory, NotEnoughMoneyException, Peer
-from yadacoin import MiningPool
+from yadacoin import MiningPool, HeaderChain, BlockHeader
 from bitcoin.wallet import CBitcoinSecret, P2PKHBitcoinAddress
+import gevent
 from gevent import pywsgi
 from miniupnpc import UPnP
 
@@ -33,6 +43,15 @@ class ChatNamespace(BaseNamespace):
     def on_error(self, event, *args):
         print 'error'
 
+class PoolNamespace(BaseNamespace):
+    events = None
+
+    def on_job(self, job):
+        self.events.put({'job': job})
+
+    def on_error(self, event, *args):
+        print 'error'
+
 def output(string):
     sys.stdout.write(string)  # write the next character
     sys.stdout.flush()                # flush stdout buffer (actual character display)
@@ -91,8 +110,10 @@ def faucet():
     Mongo.init()
     used_inputs = []
     new_inputs = []
-    for x in Mongo.site_db.faucet.find({'active': True}):
-        balance = BU.get_wallet_balance(x['address'])
+    faucet_entries = [x for x in Mongo.site_db.faucet.find({'active': True})]
+    balances = BU.get_wallet_balances([x['address'] for x in faucet_entries])
+    for x in faucet_entries:
+        balance = balances[x['address']]
         if balance >= 25:
             Mongo.site_db.faucet.update({'_id': x['_id']}, {'active': False, 'address': x['address']})
 
@@ -134,107 +155,157 @@ def faucet():
             except Exception as e:
                 print e
 
-class NonMatchingDifficultyException(Exception):
-    pass
-
 class PartialPayoutException(Exception):
     pass
 
 class PoolPayer(object):
+    def __init__(self, payout_interval=600):
+        self.payout_interval = payout_interval  # seconds between batched payout transactions
+        self.payout_confirmations = 6
+        self.max_payout_blocks = 20  # coinbases combined into one payout transaction
+
     def get_share_list_for_height(self, index):
+        share_totals = [x for x in Mongo.db.share_totals.find({'index': index})]
+        if share_totals:
+            return self.get_share_list_by_difficulty(share_totals)
+
+        # heights from before share_totals was kept
         raw_shares = [x for x in Mongo.db.shares.find({'index': index})]
-        test = Blockchain([x['block'] for x in raw_shares])
-        total_difficulty = test.get_difficulty()
+        if raw_shares and all(['difficulty' in x for x in raw_shares]):
+            return self.get_share_list_by_difficulty(raw_shares)
 
+        # older shares carry no difficulty, weigh them by the work their hash shows
         shares = {}
+        total_difficulty = 0
         for share in raw_shares:
             if share['address'] not in shares:
                 shares[share['address']] = {
-                    'blocks': []
+                    'difficulty': 0
                 }
-            shares[share['address']]['blocks'].append(share['block'])
+            work = BU.get_block_work(share['hash'])
+            shares[share['address']]['difficulty'] += work
+            total_difficulty += work
 
-        add_up = 0
         for address, item in shares.iteritems():
-            test = Blockchain(item['blocks'])
-            test_difficulty = test.get_difficulty()
-            shares[address]['payout_share'] = float(test_difficulty) / float(total_difficulty)
-            add_up += test_difficulty
+            shares[address]['payout_share'] = float(item['difficulty']) / float(total_difficulty)
+        return shares
 
-        if add_up == total_difficulty:
-            return shares
-        else:
-            raise NonMatchingDifficultyException()
+    def get_share_list_by_difficulty(self, raw_shares):
+        # shares (or per address share totals) carry the vardiff difficulty they were accepted at,
+        # so each one counts for the work it represents rather than for how lucky its hash was
+        shares = {}
+        total_difficulty = 0.0
+        for share in raw_shares:
+            if share['address'] not in shares:
+                shares[share['address']] = {
+                    'difficulty': 0.0
+                }
+            shares[share['address']]['difficulty'] += share['difficulty']
+            total_difficulty += share['difficulty']
+
+        for address, item in shares.iteritems():
+            shares[address]['payout_share'] = item['difficulty'] / total_difficulty
+        return shares
 
     def do_payout(self):
         Mongo.init()
         Peers.init()
-        # first check which blocks we won.
+        # first check which blocks we won since the watermark.
         # then determine if we have already paid out
         # they must be 6 blocks deep
         latest_block = Block.from_dict(BU.get_latest_block())
-        won_blocks = Mongo.db.blocks.find({'transactions.outputs.to': Config.address}).sort([('index', 1)])
+        state = Mongo.db.payout_state.find_one({'address': Config.address}) or {}
+        watermark = state.get('index', -1)
+        won_blocks = Mongo.db.blocks.find({
+            'index': {'$gt': watermark, '$lte': latest_block.index - self.payout_confirmations},
+            'transactions.outputs.to': Config.address
+        }).sort([('index', 1)])
+
+        unpaid = []
+        rebroadcast = set()
+        settled = True
         for won_block in won_blocks:
             won_block = Block.from_dict(won_block)
-            if (won_block.index + 6) <= latest_block.index:
-                self.do_payout_for_block(won_block)
-    
+            coinbase = won_block.get_coinbase()
+            if coinbase.outputs[0].to != Config.address or self.already_used(coinbase):
+                if settled:
+                    watermark = won_block.index
+                continue
+            settled = False
+            existing = Mongo.db.share_payout.find_one({'index': won_block.index})
+            if existing:
+                # paid but not in a block yet, rebroadcast once per payout transaction
+                pending = Mongo.db.miner_transactions.find_one({'inputs.id': coinbase.transaction_signature})
+                if not pending and existing['txn']['id'] not in rebroadcast:
+                    transaction = Transaction.from_dict(existing['txn'])
+                    TU.save(transaction)
+                    self.broadcast_transaction(transaction)
+                    rebroadcast.add(existing['txn']['id'])
+                continue
+            unpaid.append(won_block)
+
+        if watermark != state.get('index', -1):
+            Mongo.db.payout_state.update({'address': Config.address}, {'$set': {'index': watermark}}, upsert=True)
+
+        if unpaid and time.time() - state.get('last_payout', 0) >= self.payout_interval:
+            self.do_payout_for_blocks(unpaid[:self.max_payout_blocks])
+
     def already_used(self, txn):
         return Mongo.db.blocks.find_one({'transactions.inputs.id': txn.transaction_signature})
 
-    def do_payout_for_block(self, block):
-        # check if we already paid out
+    def do_payout_for_blocks(self, blocks):
+        # one transaction spends every coinbase in the batch and pays each address its
+        # combined share, so a batch costs a single fee and a single mempool entry
+        if Mongo.db.share_payout.find_one({'index': {'$in': [x.index for x in blocks]}}):
+            raise PartialPayoutException('this batch has been partially paid out.')
 
-        already_used = self.already_used(block.get_coinbase())
-        if already_used:
-            return
+        pool_take = 0.01
+        fee = 0.0001
+        payouts = {}
+        paid_blocks = []
+        total_value = 0
+        for block in blocks:
+            try:
+                shares = self.get_share_list_for_height(block.index)
+            except Exception as e:
+                # left unpaid, it comes round again next cycle
+                print 'could not get the share list for height %s:' % block.index, e
+                continue
 
-        existing = Mongo.db.share_payout.find_one({'index': block.index})
-        if existing:
-            pending = Mongo.db.miner_transactions.find_one({'inputs.id': block.get_coinbase().transaction_signature})
-            if pending:
-                return
-            else:
-                # rebroadcast
-                transaction = Transaction.from_dict(existing['txn'])
-                TU.save(transaction)
-                self.broadcast_transaction(transaction)
-                return
+            total_reward = block.get_coinbase()
+            total_value += total_reward.outputs[0].value
+            total_pool_take = total_reward.outputs[0].value * pool_take
+            total_payout = total_reward.outputs[0].value - total_pool_take
+            for address, x in shares.iteritems():
+                payouts[address] = payouts.get(address, 0) + total_payout * x['payout_share']
+            paid_blocks.append(block)
 
-        try:
-            shares = self.get_share_list_for_height(block.index)
-        except:
+        if not paid_blocks:
             return
 
-        total_reward = block.get_coinbase()
-        if total_reward.outputs[0].to != Config.address:
-            return
-        pool_take = 0.01
-        total_pool_take = total_reward.outputs[0].value * pool_take
-        total_payout = total_reward.outputs[0].value - total_pool_take
-
-        outputs = []
-        for address, x in shares.iteritems():
-            exists = Mongo.db.share_payout.find_one({'index': block.index, 'txn.outputs.to': address})
-            if exists:
-                raise PartialPayoutException('this index has been partially paid out.')
-            
-            payout = total_payout * x['payout_share']
-            outputs.append(Output(to=address, value=payout))
+        # whatever the miners don't get (the pool take, blocks with no shares) goes back to the
+        # pool as an explicit output, so the outputs add up to every coinbase in the batch and
+        # do_money can't stop short of spending all of them. one satoshi is held back so float
+        # rounding can't leave the inputs short; do_money hands it back as change
+        pool_value = total_value - sum(payouts.values()) - fee - 0.00000001
+        payouts[Config.address] = payouts.get(Config.address, 0) + pool_value
 
         try:
             transaction = TransactionFactory(
-                fee=0.0001,
+                fee=fee,
                 public_key=Config.public_key,
                 private_key=Config.private_key,
-                inputs=[Input(total_reward.transaction_signature)],
-                outputs=outputs
+                inputs=[Input(x.get_coinbase().transaction_signature) for x in paid_blocks],
+                outputs=[Output(to=address, value=value) for address, value in payouts.iteritems()]
             )
         except NotEnoughMoneyException as e:
             print "not enough money yet"
             return
-        except Exception as e:
-            print e
+
+        if len(transaction.transaction.inputs) != len(paid_blocks):
+            # every coinbase has to be spent here or its block would look paid without being settled
+            print 'payout batch did not use every coinbase'
+            return
 
         try:
             transaction.transaction.verify()
@@ -243,10 +314,12 @@ class PoolPayer(object):
             print 'faucet transaction failed'
 
         TU.save(transaction.transaction)
-        Mongo.db.share_payout.insert({'index': block.index, 'txn': transaction.transaction.to_dict()})
+        for block in paid_blocks:
+            Mongo.db.share_payout.insert({'index': block.index, 'txn': transaction.transaction.to_dict()})
+        Mongo.db.payout_state.update({'address': Config.address}, {'$set': {'last_payout': time.time()}}, upsert=True)
 
         self.broadcast_transaction(transaction.transaction)
-        
+
     def broadcast_transaction(self, transaction):
         for peer in Peers.peers:
             try:
@@ -271,12 +344,13 @@ class Consensus():
     lowest = 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
     def __init__(self):
         Mongo.init()
+        BU.ensure_chain_indexes()
         latest_block = BU.get_latest_block()
         if latest_block:
             self.latest_block = Block.from_dict(latest_block)
         else:
             self.insert_genesis()
-        self.existing_blockchain = Blockchain([x for x in Mongo.db.blocks.find({})])
+        self.existing_blockchain = HeaderChain.from_mongo()
 
     def log(self, message):
         print message
@@ -302,9 +376,25 @@ class Consensus():
 
     def verify_existing_blockchain(self):
         self.log('verifying existing blockchain')
-        result = self.existing_blockchain.verify(output)
+        # blocks are read and verified a chunk at a time, retargeting looks back through our headers
+        def get_chunks():
+            latest_block = BU.get_latest_block()
+            for start in range(0, latest_block['index'] + 1, Blockchain.verify_chunk_size):
+                yield [Block.from_dict(x) for x in Mongo.db.blocks.find({
+                    'index': {'$gte': start, '$lt': start + Blockchain.verify_chunk_size}
+                }).sort([('index', 1)])]
+        result = Blockchain.verify_chunks(
+            get_chunks(),
+            Mongo.db.blocks.count(),
+            self.existing_blockchain,
+            output,
+            multiprocessing.cpu_count()
+        )
         if not result['verified']:
+            for block in Mongo.db.blocks.find({"index": {"$gt": result['last_good_block'].index}}).sort([('index', -1)]):
+                BU.disconnect_block(block)
             Mongo.db.blocks.remove({"index": {"$gt": result['last_good_block'].index}}, multi=True)
+            self.existing_blockchain.truncate(result['last_good_block'].index)
 
     def remove_pending_transactions_now_in_chain(self):
         #remove transactions from miner_transactions collection in the blockchain
@@ -467,7 +557,20 @@ class Consensus():
             if last_block.index == (block.index - 1) and last_block.hash == block.prev_hash:
                 dup = Mongo.db.blocks.find_one({'index': block.index, 'hash': block.hash})
                 if not dup:
+                    # everything from this height up was built on the block we are replacing,
+                    # it comes off the top down so each disconnect sees the chain it was connected to
+                    replaced = [x for x in Mongo.db.blocks.find({'index': {'$gte': block.index}}).sort([('index', -1)])]
+                    for replaced_block in replaced:
+                        BU.disconnect_block(replaced_block)
+                        Mongo.db.blocks.remove({'hash': replaced_block['hash']})
+                    if replaced:
+                        self.existing_blockchain.truncate(block.index - 1)
                     Mongo.db.blocks.update({'index': block.index}, block.to_dict(), upsert=True)
+                    BU.connect_block(block.to_dict())
+                    try:
+                        self.existing_blockchain.put(BlockHeader.from_block(block))
+                    except IndexError:
+                        self.existing_blockchain = HeaderChain.from_mongo()
                     print "New block inserted for height: ", block.index
                 return True
             else:
@@ -519,29 +622,30 @@ class Consensus():
             if prev_blocks_check:
                 prev_blocks_check = Block.from_dict(prev_blocks_check)
                 print prev_blocks_check.hash, prev_blocks_check.index
-                missing_blocks = Mongo.db.blocks.find({'index': {'$lte': prev_blocks_check.index}})
-                complete_incoming_chain = blocks[:]
-                for missing_block in missing_blocks:
-                    complete_incoming_chain.append(Block.from_dict(missing_block))
                 # if we have it in our blockchain, then we've hit the fork point
                 # now we have to loop through the current block array and build a blockchain
                 # then we compare the block height and difficulty of the two chains
                 # replace our current chain if necessary by removing them from the database
                 # then looping though our new chain, inserting the new blocks
-                self.existing_blockchain = Blockchain([x for x in Mongo.db.blocks.find({})])
-                blockchain = Blockchain([x for x in complete_incoming_chain])
+                fork_header = self.existing_blockchain.blocks[prev_blocks_check.index] if len(self.existing_blockchain.blocks) > prev_blocks_check.index else None
+                if not fork_header or fork_header.hash != prev_blocks_check.hash:
+                    self.existing_blockchain = HeaderChain.from_mongo()
+                blockchain = self.existing_blockchain.fork(prev_blocks_check.index, [BlockHeader.from_block(x) for x in blocks])
 
                 # If the block height is equal, we throw out the inbound chain, it muse be greater
                 # If the block height is lower, we throw it out
                 # if the block height is heigher, we compare the difficulty of the entire chain
+                # Both chains share the work up to the fork point, so only the incoming blocks are summed.
 
-                inbound_difficulty = blockchain.get_difficulty()
+                inbound_difficulty = BU.get_chain_work(prev_blocks_check.hash) + sum([BU.get_block_work(x.hash) for x in blocks])
 
-                existing_difficulty = self.existing_blockchain.get_difficulty()
+                latest_block = BU.get_latest_block()
+                existing_difficulty = BU.get_chain_work(latest_block['hash'])
 
-                if blockchain.get_highest_block_height() > self.existing_blockchain.get_highest_block_height() \
+                if max([x.index for x in blocks]) > latest_block['index'] \
                     and inbound_difficulty > existing_difficulty:
-                    for block in sorted(blockchain.blocks, key=lambda x: x.index):
+                    # everything below the fork point is already ours, only the incoming blocks need writing
+                    for block in sorted(blocks, key=lambda x: x.index):
                         try:
                             if block.index == 0:
                                 continue
@@ -553,7 +657,7 @@ class Consensus():
                     print "Replaced chain with incoming"
                     return
                 else:
-                    print "Incoming chain lost", blockchain.get_difficulty(), self.existing_blockchain.get_difficulty(), blockchain.get_highest_block_height(), self.existing_blockchain.get_highest_block_height()
+                    print "Incoming chain lost", inbound_difficulty, existing_difficulty, max([x.index for x in blocks]), latest_block['index']
                     for block in blocks:
                         Mongo.db.consensus.update({'block.hash': block.hash}, {'$set': {'ignore': True}}, multi=True)
                     return
@@ -578,8 +682,12 @@ if __name__ == '__main__':
     parser.add_argument('config', default="config.json", nargs="?", help='config file')
     parser.add_argument('to', default="", nargs="?", help='to')
     parser.add_argument('value', default=0, nargs="?", help='amount')
-    parser.add_argument('-c', '--cores', default=multiprocessing.cpu_count(), help='Specify number of cores to use')
+    parser.add_argument('-c', '--cores', default=None, help='Specify number of cores to use, defaults to the best result of --benchmark or all cores')
+    parser.add_argument('-b', '--benchmark', action='store_true', help='Measure hashrate on 1..N cores and remember the best core count')
+    parser.add_argument('--benchmark-time', default=10, type=int, help='Seconds to hash at each core count when benchmarking')
     parser.add_argument('-p', '--pool', default='', help='Specify pool to use')
+    parser.add_argument('--payout-interval', default=600, type=int, help='Seconds between batched pool payouts')
+    parser.add_argument('-s', '--solo', action='store_true', help='Mine on our own node, building templates in process instead of using a pool')
     args = parser.parse_args()
 
     if args.mode == 'config' and args.config:
@@ -616,31 +724,144 @@ if __name__ == '__main__':
     elif args.mode == 'mine':
         print Config.to_json()
         print '\r\n\r\n\r\n//// YADA COIN MINER ////'
+        benchmark_file = os.path.join(os.path.dirname(os.path.abspath(args.config)), 'benchmark.json')
+        if args.benchmark:
+            results = MiningPool.benchmark(int(args.cores or multiprocessing.cpu_count()), args.benchmark_time)
+            with open(benchmark_file, 'w') as f:
+                f.write(json.dumps(results, indent=4))
+            print 'Best core count:', MiningPool.get_benchmark_cores(results)
+            exit()
+        if not args.cores:
+            if os.path.isfile(benchmark_file):
+                with open(benchmark_file) as f:
+                    args.cores = MiningPool.get_benchmark_cores(json.loads(f.read()))
+            else:
+                args.cores = multiprocessing.cpu_count()
         print "Core count:", args.cores
+        # ranges we finished since the last request and our per core hashrate,
+        # the pool uses both to size our next range and to track what is outstanding
+        finished = []
+        hashrate = [None]
         def get_mine_data():
-            return json.loads(requests.get("http://{pool}/pool".format(pool=args.pool)).content)
-        running_processes = []
+            params = {
+                'address': Config.address,
+                'done': ','.join(['%s:%s' % x for x in finished])
+            }
+            if hashrate[0]:
+                params['hashrate'] = int(hashrate[0])
+            data = json.loads(requests.get("http://{pool}/pool".format(pool=args.pool), params=params).content)
+            del finished[:]
+            return data
         Mongo.init()
         while 1:
             Peers.init(my_peer=False)
-            if not Peers.peers:
-                time.sleep(1)
-                continue
-            if len(running_processes) >= int(args.cores):
-                for i, proc in enumerate(running_processes):
-                    if not proc.is_alive():
-                        proc.terminate()
-                        data = get_mine_data()
-                        p = Process(target=MiningPool.pool_mine, args=(args.pool, Config.address, data['header'], data['target'], data['nonces'], data['special_min']))
-                        p.start()
-                        running_processes[i] = p
-            else:
-                data = get_mine_data()
-                p = Process(target=MiningPool.pool_mine, args=(args.pool, Config.address, data['header'], data['target'], data['nonces'], data['special_min']))
-                p.start()
-                running_processes.append(p)
+            if Peers.peers:
+                break
             time.sleep(1)
 
+        if args.solo:
+            # no pool to talk to, the template is built here and handed to the
+            # workers through shared memory and a winning block is broadcast directly
+            job = MiningPool.make_solo_job()
+            results = multiprocessing.Queue()
+            for i in range(int(args.cores)):
+                p = Process(target=MiningPool.solo_worker, args=(job, results))
+                p.daemon = True
+                p.start()
+            MiningPool.start_template_builder(Config.to_dict())
+            job_id = None
+            found_job_id = None
+            while 1:
+                block_factory = MiningPool.get_template()
+                if block_factory.job_id != job_id:
+                    MiningPool.publish_solo_job(job, block_factory)
+                    job_id = block_factory.job_id
+                try:
+                    result = results.get(timeout=0.2)
+                except Queue.Empty:
+                    continue
+                if result['job_id'] == found_job_id:
+                    continue
+                block = MiningPool.get_solo_block(result)
+                if block:
+                    found_job_id = result['job_id']
+                    MiningPool.broadcast_block(block)
+                elif result['job_id'] == job_id:
+                    # the finding worker parked everyone, put them back to work on it
+                    # past the nonces already handed out
+                    MiningPool.publish_solo_job(job, block_factory, resume=True)
+
+        jobs = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        # tip id of the newest job we have been handed, workers abandon jobs built on an older tip
+        current_tip = Value('i', 0)
+        workers = []
+        for i in range(int(args.cores)):
+            p = Process(target=MiningPool.pool_worker, args=(jobs, results, current_tip))
+            p.daemon = True
+            p.start()
+            workers.append(p)
+
+        def listen_for_jobs():
+            # the pool pushes a job the moment its template changes, so we
+            # don't have to wait for the next poll to stop hashing a stale header
+            host, port = args.pool.split(':')
+            PoolNamespace.events = results
+            while 1:
+                try:
+                    socketIO = SocketIO(host, int(port), wait_for_connection=False, params={'address': Config.address})
+                    socketIO.define(PoolNamespace, '/pool')
+                    socketIO.wait()
+                except Exception as e:
+                    print 'pool push channel failed:', e
+                time.sleep(10)
+        listener = threading.Thread(target=listen_for_jobs)
+        listener.daemon = True
+        listener.start()
+
+        # keep a second job queued behind every running one so a worker
+        # picks up its next range the moment it finishes the current one
+        max_pending = int(args.cores) * 2
+        pending = 0
+        while 1:
+            try:
+                while pending < max_pending:
+                    data = get_mine_data()
+                    current_tip.value = data.get('tip_id', 0)
+                    jobs.put(data)
+                    pending += 1
+            except Exception as e:
+                print 'failed to get work from pool:', e
+                if not pending:
+                    time.sleep(1)
+                    continue
+            result = results.get()
+            if 'job' in result:
+                if result['job'].get('tip_id', 0) != current_tip.value:
+                    # the queued jobs are on the old tip, drop them and start on the new one.
+                    # a same tip push (mempool refresh) just queues behind them, their
+                    # ranges are still good and the pool expects to hear they were done
+                    while 1:
+                        try:
+                            jobs.get_nowait()
+                            pending -= 1
+                        except Queue.Empty:
+                            break
+                    current_tip.value = result['job'].get('tip_id', 0)
+                jobs.put(result['job'])
+                pending += 1
+                continue
+            pending -= 1
+            if result['job_id'] is not None:
+                finished.append((result['job_id'], result['nonces'][0]))
+            if result['hashrate']:
+                hashrate[0] = result['hashrate'] if not hashrate[0] else hashrate[0] * 0.8 + result['hashrate'] * 0.2
+            for nonce, lhash in result['shares']:
+                try:
+                    MiningPool.pool_submit(args.pool, Config.address, nonce, lhash, result['job_id'], result['share_target'])
+                except Exception as e:
+                    print 'failed to submit to pool:', e
+
 
     elif args.mode == 'faucet':
         while 1:
@@ -656,7 +877,7 @@ if __name__ == '__main__':
             """
             time.sleep(1)
     elif args.mode == 'pool':
-        pp = PoolPayer()
+        pp = PoolPayer(args.payout_interval)
         while 1:            
             pp.do_payout()
             time.sleep(1)
@@ -730,11 +951,38 @@ if __name__ == '__main__':
                     print 'found duplicate'
                     return
                 Mongo.db.miner_transactions.update(incoming_txn.to_dict(), incoming_txn.to_dict(), upsert=True)
+                MiningPool.request_rebuild()
             except Exception as e:
                 print e
             except BaseException as e:
                 print e
 
+        pool_miners = {}
+
+        @sio.on('connect', namespace='/pool')
+        def pool_connect(sid, environ):
+            query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+            pool_miners[sid] = query.get('address', [None])[0]
+
+        @sio.on('disconnect', namespace='/pool')
+        def pool_disconnect(sid):
+            pool_miners.pop(sid, None)
+
+        def pool_job_pusher():
+            # templates are built on MiningPool's builder thread, we only
+            # notice the swap here and push from the server's own loop
+            pushed_job_id = None
+            while 1:
+                block_factory = MiningPool.get_template()
+                if block_factory and block_factory.job_id != pushed_job_id:
+                    pushed_job_id = block_factory.job_id
+                    for sid, address in pool_miners.items():
+                        try:
+                            sio.emit('job', MiningPool.next_job(address), room=sid, namespace='/pool')
+                        except Exception as e:
+                            print 'pool job push failed:', e
+                gevent.sleep(0.2)
+
         @sio.on('getblock', namespace='/chat')
         def sio_getblock(sid, data):
             return json.dumps(Mongo.db.blocks.find_one({'hash': data['hash']}, {'_id': 0}))
@@ -798,6 +1046,7 @@ if __name__ == '__main__':
         app.add_url_rule('/get-graph-new-messages', view_func=endpoints.GraphNewMessagesView.as_view('graphnewmessages'), methods=['GET', 'POST'])
         app.add_url_rule('/wallet', view_func=endpoints.WalletView.as_view('wallet'))
         app.add_url_rule('/faucet', view_func=endpoints.FaucetView.as_view('faucet'))
+        app.add_url_rule('/merkle-proof', view_func=endpoints.MerkleProofView.as_view('merkleproof'))
         app.add_url_rule('/pool', view_func=endpoints.MiningPoolView.as_view('pool'))
         app.add_url_rule('/pool-submit', view_func=endpoints.MiningPoolSubmitView.as_view('poolsubmit'), methods=['GET', 'POST'])
         app.add_url_rule('/pool-explorer', view_func=endpoints.MiningPoolExplorerView.as_view('pool-explorer'))
@@ -852,4 +1101,5 @@ if __name__ == '__main__':
         Peers.init()
         if not Peers.peers:
             raise Exception("peer service unavailble, restart this process")
+        gevent.spawn(pool_job_pusher)
         pywsgi.WSGIServer((Config.serve_host, Config.serve_port), app).serve_forever()
\ No newline at end of file
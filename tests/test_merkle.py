@@ -0,0 +1,61 @@
+import os
+import sys
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from yadacoin import MerkleTree
+
+
+def reference_merkle_root(txn_hashes):
+    # the recursive Block.set_merkle_root blocks were built with
+    hashes = []
+    for i in range(0, len(txn_hashes), 2):
+        txn1 = txn_hashes[i]
+        try:
+            txn2 = txn_hashes[i+1]
+        except:
+            txn2 = ''
+        hashes.append(hashlib.sha256(txn1+txn2).digest().encode('hex'))
+    if len(hashes) > 1:
+        return reference_merkle_root(hashes)
+    return hashes[0]
+
+
+def get_txn_hashes(count):
+    return sorted([hashlib.sha256(str(i)).digest().encode('hex') for i in range(count)], key=str.lower)
+
+
+class TestMerkleTree(unittest.TestCase):
+    def test_root_matches_set_merkle_root(self):
+        for count in range(1, 34):
+            txn_hashes = get_txn_hashes(count)
+            self.assertEqual(MerkleTree(txn_hashes).root, reference_merkle_root(txn_hashes))
+
+    def test_proofs_verify(self):
+        for count in [1, 2, 3, 7, 8, 13]:
+            txn_hashes = get_txn_hashes(count)
+            merkle_tree = MerkleTree(txn_hashes)
+            for txn_hash in txn_hashes:
+                proof = merkle_tree.get_proof(txn_hash)
+                self.assertTrue(MerkleTree.verify_proof(txn_hash, proof, merkle_tree.root))
+
+    def test_proof_format(self):
+        txn_hashes = get_txn_hashes(3)
+        proof = MerkleTree(txn_hashes).get_proof(txn_hashes[2])
+        self.assertEqual(proof, [
+            {'hash': '', 'side': 'right'},
+            {'hash': MerkleTree.hash_pair(txn_hashes[0], txn_hashes[1]), 'side': 'left'}
+        ])
+
+    def test_proof_fails_for_other_root(self):
+        txn_hashes = get_txn_hashes(5)
+        merkle_tree = MerkleTree(txn_hashes)
+        proof = merkle_tree.get_proof(txn_hashes[1])
+        self.assertFalse(MerkleTree.verify_proof(txn_hashes[0], proof, merkle_tree.root))
+        self.assertFalse(MerkleTree.verify_proof(txn_hashes[1], proof, MerkleTree(txn_hashes[:4]).root))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from yadacoin import BlockFactory
+
+
+HEADER = '2' + '1537127756' + '02' + 'ab' * 32 + '100000' + 'ff' * 32 + '{nonce}' + 'False' + 'f' * 63 + 'cd' * 32
+
+
+def reference_mine(header, target, nonces, special_min=False):
+    # the loop mining used before headers were compiled, first hash under the target wins
+    lowest = None
+    for nonce in xrange(nonces[0], nonces[1]):
+        lhash = BlockFactory.generate_hash_from_header(header, nonce)
+        if int(lhash, 16) < target or special_min:
+            return nonce, lhash
+        if lowest is None or lhash < lowest[1]:
+            lowest = (nonce, lhash)
+    return lowest
+
+
+class TestMine(unittest.TestCase):
+    def test_compiled_header_hashes_match(self):
+        compiled_header = BlockFactory.compile_header(HEADER)
+        for nonce in [0, 1, 9, 10, 99999, 4294967295]:
+            self.assertEqual(
+                BlockFactory.generate_hash_from_compiled_header(compiled_header, nonce),
+                BlockFactory.generate_hash_from_header(HEADER, nonce)
+            )
+
+    def test_finds_the_same_nonce(self):
+        target = 2 ** 248
+        nonces = [0, 3000]
+        self.assertEqual(BlockFactory.mine(HEADER, target, nonces), reference_mine(HEADER, target, nonces))
+
+    def test_returns_the_lowest_hash_when_nothing_is_found(self):
+        nonces = [500, 1500]
+        self.assertEqual(BlockFactory.mine(HEADER, 0, nonces), reference_mine(HEADER, 0, nonces))
+
+    def test_finds_across_batches(self):
+        mine_batch_size = BlockFactory.mine_batch_size
+        BlockFactory.mine_batch_size = 7
+        try:
+            target = 2 ** 250
+            nonces = [0, 2000]
+            self.assertEqual(BlockFactory.mine(HEADER, target, nonces), reference_mine(HEADER, target, nonces))
+        finally:
+            BlockFactory.mine_batch_size = mine_batch_size
+
+    def test_special_min_takes_the_first_nonce(self):
+        nonces = [42, 100]
+        self.assertEqual(BlockFactory.mine(HEADER, 0, nonces, True), reference_mine(HEADER, 0, nonces, True))
+
+    def test_collects_every_share(self):
+        share_target = 2 ** 252
+        nonces = [0, 1000]
+        shares = []
+        BlockFactory.mine(HEADER, 0, nonces, share_target=share_target, shares=shares)
+        expected = []
+        for nonce in xrange(nonces[0], nonces[1]):
+            lhash = BlockFactory.generate_hash_from_header(HEADER, nonce)
+            if int(lhash, 16) < share_target:
+                expected.append((nonce, lhash))
+        self.assertTrue(expected)
+        self.assertEqual(shares, expected)
+
+    def test_cancelled(self):
+        self.assertEqual(BlockFactory.mine(HEADER, 0, [0, 100], cancelled=lambda: True), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import json
+import hashlib
+from yadacoin import Config, Mongo, Block, BlockFactory, MiningPool
+
+with open('config/config.json') as f:
+    Config.from_dict(json.loads(f.read()))
+
+Mongo.init()
+
+# move shares stored with their full block over to the compact schema,
+# one share_templates record per distinct header the shares were mined on
+saved_templates = set()
+migrated = 0
+for share in Mongo.db.shares.find({'block': {'$exists': True}}):
+    block = Block.from_dict(share['block'])
+    template_id = hashlib.sha256(BlockFactory.generate_header(block)).digest().encode('hex')
+    if template_id not in saved_templates:
+        Mongo.db.share_templates.update({
+            'id': template_id
+        },
+        {
+            'id': template_id,
+            'index': block.index,
+            'block': MiningPool.get_template_dict(block)
+        }, upsert=True)
+        saved_templates.add(template_id)
+
+    Mongo.db.shares.update({'_id': share['_id']}, {
+        '$set': {
+            'nonce': block.nonce,
+            'template': template_id
+        },
+        '$unset': {
+            'block': ''
+        }
+    })
+    migrated += 1
+
+print 'migrated', migrated, 'shares to', len(saved_templates), 'templates'
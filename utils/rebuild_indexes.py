@@ -0,0 +1,11 @@
+import json
+from yadacoin import Config, Mongo, BU
+
+with open('config/config.json') as f:
+    Config.from_dict(json.loads(f.read()))
+
+Mongo.init()
+
+# rebuilds every collection BU.connect_block maintains from the blocks collection
+BU.rebuild_chain_indexes()
+print 'rebuilt chain indexes up to height', BU.get_latest_block()['index']
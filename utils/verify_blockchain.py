@@ -1,5 +1,6 @@
 import sys
 import json
+import multiprocessing
 from pymongo import MongoClient
 from yadacoin import Transaction, TU, BU, Blockchain, Config, Mongo
 from bitcoin.wallet import CBitcoinSecret, P2PKHBitcoinAddress
@@ -19,7 +20,7 @@ with open('config/config.json') as f:
 Mongo.init()
 blocks = BU.get_blocks()
 blockchain = Blockchain(blocks)
-blockchain.verify(output)
+blockchain.verify(output, multiprocessing.cpu_count())
 
 
 res = Mongo.db.blocks.aggregate([
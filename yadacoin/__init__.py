@@ -1,9 +1,11 @@
 from block import BlockFactory, Block
 from blockchain import Blockchain, BlockChainException
 from blockchainutils import BU
+from headerchain import HeaderChain, BlockHeader
 from config import Config
 from crypt import Crypt
 from graph import Graph
+from merkle import MerkleTree
 from mongo import Mongo
 from peers import Peers, Peer
 from transaction import TransactionFactory, Transaction, \
@@ -14,6 +14,7 @@ from pbkdf2 import PBKDF2
 from transaction import TransactionFactory, Transaction, Output
 from blockchainutils import BU
 from transactionutils import TU
+from merkle import MerkleTree
 from bitcoin.signmessage import BitcoinMessage, VerifyMessage, SignMessage
 from bitcoin.wallet import CBitcoinSecret, P2PKHBitcoinAddress
 from coincurve.utils import verify_signature
@@ -56,8 +57,7 @@ class BlockFactory(object):
             if address in unspent_indexed:
                 unspent_ids = unspent_indexed[address]
             else:
-                res = BU.get_wallet_unspent_transactions(address)
-                unspent_ids = [x['id'] for x in res]
+                unspent_ids = BU.get_unspent_ids(address)
                 unspent_indexed[address] = unspent_ids
 
             failed = False
@@ -114,22 +114,56 @@ class BlockFactory(object):
         header = header.format(nonce=nonce)
         return hashlib.sha256(hashlib.sha256(header).digest()).digest()[::-1].encode('hex')
 
+    @classmethod
+    def compile_header(cls, header):
+        # everything before {nonce} is fixed for the life of a job, so we hash it once
+        # and hand out copies of that sha256 state instead of rebuilding the whole string
+        prefix, suffix = str(header).split('{nonce}', 1)
+        return hashlib.sha256(prefix), suffix
+
+    @classmethod
+    def generate_hash_from_compiled_header(cls, compiled_header, nonce):
+        prefix_state, suffix = compiled_header
+        first = prefix_state.copy()
+        first.update(str(nonce) + suffix)
+        return hashlib.sha256(first.digest()).digest()[::-1].encode('hex')
+
+    @classmethod
+    def target_to_digest(cls, target):
+        # big endian bytes of the target so raw digests can be compared without hex/int conversion
+        if target > 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff:
+            # a 33 byte value sorts after every 32 byte digest
+            return '\xff' * 33
+        return format(target, '064x').decode('hex')
+
+    @classmethod
+    def mine_batch(cls, compiled_header, target_digest, start, end, special_min=False, share_digest=None, shares=None):
+        # returns (found, nonce, digest) where digest is the big endian double sha256
+        # of the winning nonce, or of the lowest nonce in the batch when nothing was found.
+        # With share_digest every (nonce, hex digest) below it is appended to shares as well
+        prefix_state, suffix = compiled_header
+        copy = prefix_state.copy
+        sha256 = hashlib.sha256
+        lowest_digest = None
+        lowest_nonce = start
+        for nonce in xrange(start, end):
+            first = copy()
+            first.update(str(nonce) + suffix)
+            digest = sha256(first.digest()).digest()[::-1]
+            if share_digest is not None and digest < share_digest:
+                shares.append((nonce, digest.encode('hex')))
+            if digest < target_digest or special_min:
+                return True, nonce, digest
+            if lowest_digest is None or digest < lowest_digest:
+                lowest_digest = digest
+                lowest_nonce = nonce
+        return False, lowest_nonce, lowest_digest
+
     def get_transaction_hashes(self):
         return sorted([str(x.hash) for x in self.transactions], key=str.lower)
 
     def set_merkle_root(self, txn_hashes):
-        hashes = []
-        for i in range(0, len(txn_hashes), 2):
-            txn1 = txn_hashes[i]
-            try:
-                txn2 = txn_hashes[i+1]
-            except:
-                txn2 = ''
-            hashes.append(hashlib.sha256(txn1+txn2).digest().encode('hex'))
-        if len(hashes) > 1:
-            self.set_merkle_root(hashes)
-        else:
-            self.merkle_root = hashes[0]
+        self.merkle_root = MerkleTree(txn_hashes).root
 
     @classmethod
     def get_target(cls, height, last_time, last_block, blockchain):
@@ -175,21 +209,29 @@ class BlockFactory(object):
                     break
         return target
 
-    @classmethod
-    def mine(cls, header, target, nonces, special_min=False):
+    mine_batch_size = 10000
 
-        lowest = (0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff, 0, '')
-        nonce = nonces[0]
-        while nonce < nonces[1]:
-            hash_test = cls.generate_hash_from_header(header, str(nonce))
-
-            text_int = int(hash_test, 16)
-            if text_int < target or special_min:
-                return nonce, hash_test
-
-            if text_int < lowest[0]:
-                lowest = (text_int, nonce, hash_test)
-            nonce += 1
+    @classmethod
+    def mine(cls, header, target, nonces, special_min=False, cancelled=None, share_target=None, shares=None):
+        # cancelled is checked between batches, when it returns True the header
+        # has been superseded and the rest of the range is abandoned.
+        # With share_target, (nonce, hash) for every nonce beating it is added to shares
+        compiled_header = cls.compile_header(header)
+        target_digest = cls.target_to_digest(target)
+        share_digest = cls.target_to_digest(share_target) if share_target is not None else None
+        lowest = ('\xff' * 32, 0, '')
+        start = nonces[0]
+        while start < nonces[1]:
+            if cancelled and cancelled():
+                return None, None
+            end = min(start + cls.mine_batch_size, nonces[1])
+            found, nonce, digest = cls.mine_batch(compiled_header, target_digest, start, end, special_min, share_digest, shares)
+            if found:
+                return nonce, digest.encode('hex')
+
+            if digest is not None and digest < lowest[0]:
+                lowest = (digest, nonce, digest.encode('hex'))
+            start = end
         return lowest[1], lowest[2]
 
     @classmethod
@@ -248,8 +290,6 @@ class Block(object):
         self.prev_hash = prev_hash
         self.nonce = nonce
         self.transactions = transactions
-        txn_hashes = self.get_transaction_hashes()
-        self.set_merkle_root(txn_hashes)
         self.merkle_root = merkle_root
         self.hash = block_hash
         self.public_key = public_key
@@ -283,19 +323,37 @@ class Block(object):
             target=int(block.get('target'), 16)
         )
     
+    @property
+    def transactions(self):
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, transactions):
+        self._transactions = transactions
+        self._verify_merkle_root = None
+
+    @property
+    def verify_merkle_root(self):
+        # only verify needs this, so it is worked out on first use and kept until the transactions are replaced
+        if self._verify_merkle_root is None:
+            self.set_merkle_root(self.get_transaction_hashes())
+        return self._verify_merkle_root
+
+    @verify_merkle_root.setter
+    def verify_merkle_root(self, verify_merkle_root):
+        self._verify_merkle_root = verify_merkle_root
+
     def get_coinbase(self):
         for txn in self.transactions:
             if str(P2PKHBitcoinAddress.from_pubkey(self.public_key.decode('hex'))) in [x.to for x in txn.outputs] and len(txn.outputs) == 1 and not txn.relationship:
                 return txn
 
 
-    def verify(self):
+    def verify(self, check_signature=True):
         getcontext().prec = 8
         if int(self.version) != int(BU.get_version_for_height(self.index)):
             raise BaseException("Wrong version for block height", self.version, BU.get_version_for_height(self.index))
         try:
-            txns = self.get_transaction_hashes()
-            self.set_merkle_root(txns)
             if self.verify_merkle_root != self.merkle_root:
                 raise BaseException("Invalid block")
         except:
@@ -309,18 +367,8 @@ class Block(object):
         except:
             raise
 
-        address = P2PKHBitcoinAddress.from_pubkey(self.public_key.decode('hex'))
-        try:
-            result = verify_signature(base64.b64decode(self.signature), self.hash, self.public_key.decode('hex'))
-            if not result:
-                raise Exception("block signature is invalid")
-        except:
-            try:
-                result = VerifyMessage(address, BitcoinMessage(self.hash, magic=''), self.signature)
-                if not result:
-                    raise
-            except:
-                raise BaseException("block signature is invalid")
+        if check_signature and not TU.verify_signature(self.hash, self.signature, self.public_key):
+            raise BaseException("block signature is invalid")
 
         # verify reward
         coinbase_sum = 0
@@ -342,26 +390,14 @@ class Block(object):
         return sorted([str(x.hash) for x in self.transactions], key=str.lower)
 
     def set_merkle_root(self, txn_hashes):
-        hashes = []
-        for i in range(0, len(txn_hashes), 2):
-            txn1 = txn_hashes[i]
-            try:
-                txn2 = txn_hashes[i+1]
-            except:
-                txn2 = ''
-            hashes.append(hashlib.sha256(txn1+txn2).digest().encode('hex'))
-        if len(hashes) > 1:
-            self.set_merkle_root(hashes)
-        else:
-            self.verify_merkle_root = hashes[0]
+        self.verify_merkle_root = MerkleTree(txn_hashes).root
 
     def save(self):
         self.verify()
         for txn in self.transactions:
             if txn.inputs:
                 address = str(P2PKHBitcoinAddress.from_pubkey(txn.public_key.decode('hex')))
-                unspent = BU.get_wallet_unspent_transactions(address, [x.id for x in txn.inputs])
-                unspent_ids = [x['id'] for x in unspent]
+                unspent_ids = BU.get_unspent_ids(address, [x.id for x in txn.inputs])
                 failed = False
                 used_ids_in_this_txn = []
                 for x in txn.inputs:
@@ -375,10 +411,13 @@ class Block(object):
         res = Mongo.db.blocks.find({"index": (int(self.index) - 1)})
         if res.count() and res[0]['hash'] == self.prev_hash or self.index == 0:
             Mongo.db.blocks.insert(self.to_dict())
+            BU.connect_block(self.to_dict())
         else:
             print "CRITICAL: block rejected..."
 
     def delete(self):
+        for block in Mongo.db.blocks.find({"index": self.index}):
+            BU.disconnect_block(block)
         Mongo.db.blocks.remove({"index": self.index})
 
     def to_dict(self):
@@ -1,10 +1,17 @@
 import re
+import multiprocessing
 from block import Block, BlockFactory
+from transactionutils import TU
 
 class BlockChainException(BaseException):
     pass
 
+def verify_signature_task(args):
+    return TU.check_signature(*args)
+
 class Blockchain(object):
+    verify_chunk_size = 1000  # blocks whose signatures are checked together in parallel mode
+
     def __init__(self, blocks=None):
         if blocks:
             new_block_array = []
@@ -18,39 +25,80 @@ class Blockchain(object):
         else:
             self.blocks = []
 
-    def verify(self, progress=None):
-        last_block = None
-        for block in self.blocks:
-            try:
-                block.verify()
-            except:
-                if last_block:
-                    return {'verified': False, 'last_good_block': last_block}
-                else:
-                    return {'verified': False}
-            for txn in block.transactions:
-                try:
-                    txn.verify()
-                except:
+    def verify(self, progress=None, processes=None):
+        chunks = (self.blocks[i:i + self.verify_chunk_size] for i in range(0, len(self.blocks), self.verify_chunk_size))
+        return self.verify_chunks(chunks, len(self.blocks), self, progress, processes)
+
+    @classmethod
+    def verify_chunks(cls, chunks, count, headers, progress=None, processes=None):
+        # chunks yields lists of consecutive Blocks, so only one chunk has to be in memory.
+        # headers is anything whose blocks[i] is the block at height i (a Blockchain or a
+        # HeaderChain), it is what retargeting looks back through.
+        # signatures don't depend on anything before them, so with processes set they are
+        # checked in parallel a chunk of blocks at a time and everything else stays in order
+        pool = multiprocessing.Pool(processes) if processes and processes > 1 else None
+        try:
+            last_block = None
+            for blocks in chunks:
+                signatures = cls.verify_signatures(blocks, pool, processes) if pool else None
+                for j, block in enumerate(blocks):
+                    try:
+                        if signatures and not signatures[j]:
+                            raise BaseException("block or transaction signature is invalid")
+                        block.verify(check_signature=not pool)
+                    except:
+                        if last_block:
+                            return {'verified': False, 'last_good_block': last_block}
+                        else:
+                            return {'verified': False}
+                    for txn in block.transactions:
+                        try:
+                            txn.verify(check_signature=not pool)
+                        except:
+                            if last_block:
+                                return {'verified': False, 'last_good_block': last_block}
+                            else:
+                                return {'verified': False}
                     if last_block:
-                        return {'verified': False, 'last_good_block': last_block}
-                    else:
-                        return {'verified': False}
-            if last_block:
-                target = BlockFactory.get_target(block.index, last_block.time, last_block, self)
-                if int(block.hash, 16) > target and not block.special_min:
-                    print "invalid block chain: block target is not below the previous target and not special minimum"
-                    return {'verified': False, 'last_good_block': last_block}
-                if block.prev_hash != last_block.hash:
-                    print "invalid block chain: hashes are not consecutive:", last_block.hash, block.prev_hash, last_block.index, block.index
-                    return {'verified': False, 'last_good_block': last_block}
-                if block.index - last_block.index != 1:
-                    print "invalid block chain: indexes are not consecutive:", last_block.index, block.index
-                    return {'verified': False, 'last_good_block': last_block}
-            last_block = block
-            if progress:
-                progress("%s%s" % (str(int(float(block.index + 1) / float(len(self.blocks)) * 100)), '%'))
-        return {'verified': True}
+                        target = BlockFactory.get_target(block.index, last_block.time, last_block, headers)
+                        if int(block.hash, 16) > target and not block.special_min:
+                            print "invalid block chain: block target is not below the previous target and not special minimum"
+                            return {'verified': False, 'last_good_block': last_block}
+                        if block.prev_hash != last_block.hash:
+                            print "invalid block chain: hashes are not consecutive:", last_block.hash, block.prev_hash, last_block.index, block.index
+                            return {'verified': False, 'last_good_block': last_block}
+                        if block.index - last_block.index != 1:
+                            print "invalid block chain: indexes are not consecutive:", last_block.index, block.index
+                            return {'verified': False, 'last_good_block': last_block}
+                    last_block = block
+                    if progress:
+                        progress("%s%s" % (str(int(float(block.index + 1) / float(count) * 100)), '%'))
+            return {'verified': True}
+        finally:
+            if pool:
+                pool.terminate()
+
+    @classmethod
+    def verify_signatures(cls, blocks, pool, processes):
+        # one flag per block, True when the block and all of its transactions are signed correctly
+        tasks = []
+        owners = []
+        for i, block in enumerate(blocks):
+            signatures = [(block.hash, block.signature, block.public_key)]
+            signatures.extend([(txn.hash, txn.transaction_signature, txn.public_key) for txn in block.transactions])
+            for signature in signatures:
+                if not TU.signature_verified(*signature):
+                    tasks.append(signature)
+                    owners.append(i)
+        results = [True for x in blocks]
+        chunksize = max(1, len(tasks) / (processes * 4))
+        for task, owner, result in zip(tasks, owners, pool.map(verify_signature_task, tasks, chunksize)):
+            if result:
+                # the workers' caches die with them, keep what they verified here
+                TU.add_verified_signature(*task)
+            else:
+                results[owner] = False
+        return results
 
     def find_error_block(self):
         last_block = None
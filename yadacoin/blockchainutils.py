@@ -15,14 +15,17 @@ from bitcoin.wallet import CBitcoinSecret
 from bitcoin.signmessage import BitcoinMessage, VerifyMessage, SignMessage
 from bitcoin.wallet import CBitcoinSecret, P2PKHBitcoinAddress
 from bson.son import SON
+from pymongo import ReplaceOne, DeleteOne, DeleteMany, UpdateOne, UpdateMany
 from coincurve import PrivateKey
 from mongo import Mongo
 from config import Config
+from singleflight import single_flight
 
 
 class BU(object):  # Blockchain Utilities
     collection = None
     database = None
+    max_target = 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
     @classmethod
     def get_blocks(cls):
         return Mongo.db.blocks.find({}, {'_id': 0}).sort([('index', 1)])
@@ -53,18 +56,28 @@ class BU(object):  # Blockchain Utilities
 
     @classmethod
     def get_wallet_balance(cls, address):
-        unspent_transactions = cls.get_wallet_unspent_transactions(address)
-        balance = 0
-        for txn in unspent_transactions:
-            for output in txn['outputs']:
-                if address == output['to']:
-                    balance += float(output['value'])
-        if balance:
-            return balance
-        else:
-            return 0
+        return cls.get_wallet_balances([address])[address]
+
+    @classmethod
+    @single_flight
+    def get_wallet_balances(cls, addresses):
+        # address -> confirmed balance, from the totals kept as blocks connect and disconnect
+        balances = dict([(x, 0) for x in addresses])
+        for x in Mongo.db.balances.find({'address': {'$in': list(balances.keys())}}, {'address': 1, 'satoshis': 1}):
+            if x['satoshis']:
+                balances[x['address']] = x['satoshis'] / 100000000.0
+        return balances
+
+    @classmethod
+    def get_unspent_ids(cls, address, ids=None):
+        # ids of the transactions with an output to address that address hasn't spent
+        query = {'address': address}
+        if ids is not None:
+            query['id'] = {'$in': ids}
+        return [x['id'] for x in Mongo.db.utxos.find(query, {'id': 1})]
 
     @classmethod
+    @single_flight
     def get_wallet_unspent_transactions(cls, address, ids=None, needed_value=None):
         res = cls.wallet_unspent_worker(address, ids, needed_value)
         for x in res:
@@ -73,19 +86,39 @@ class BU(object):  # Blockchain Utilities
 
     @classmethod
     def wallet_unspent_worker(cls, address, ids=None, needed_value=None):
-        unspent_cache = Mongo.db.unspent_cache.find({'address': address}).sort([('height', -1)])
+        # unspent_cache_state holds how far up the chain this address has been scanned.
+        # It only moves once the rows for that range are written, so a scan that dies
+        # part way is simply repeated from the same height next time.
+        state = Mongo.db.unspent_cache_state.find_one({'address': address})
+        if state:
+            block_height = state['height']
+            reverse_public_key = state.get('public_key', '')
+        else:
+            unspent_cache = Mongo.db.unspent_cache.find({'address': address}).sort([('height', -1)])
+            if unspent_cache.count():
+                unspent_cache = unspent_cache[0]
+                block_height = unspent_cache['height']
+            else:
+                block_height = 0
+            reverse_public_key = ''
 
-        if unspent_cache.count():
-            unspent_cache = unspent_cache[0]
-            block_height = unspent_cache['height']
+        latest_block = cls.get_latest_block()
+        scan_height = latest_block['index'] if latest_block else 0
+        if scan_height > block_height:
+            cls.update_unspent_cache(address, block_height, scan_height, reverse_public_key)
+
+        if ids:
+            res = Mongo.db.unspent_cache.find({'address': address, 'spent': False, 'id': {'$in': ids}})
         else:
-            block_height = 0
+            res = Mongo.db.unspent_cache.find({'address': address, 'spent': False})
+        return res
 
+    @classmethod
+    def update_unspent_cache(cls, address, block_height, scan_height, reverse_public_key):
+        scan_range = {"index": {"$gt": block_height, "$lte": scan_height}}
         received_query = [
             {
-                "$match": {
-                    "index": {"$gt": block_height}
-                }
+                "$match": scan_range
             },
             {
                 "$match": {
@@ -120,9 +153,9 @@ class BU(object):  # Blockchain Utilities
 
         received = Mongo.db.blocks.aggregate(received_query, allowDiskUse=True)
 
-        reverse_public_key = ''
+        ops = []
         for x in received:
-            Mongo.db.unspent_cache.update({
+            ops.append(ReplaceOne({
                 'address': address,
                 'id': x['txn']['id'],
                 'height': x['height'],
@@ -134,76 +167,66 @@ class BU(object):  # Blockchain Utilities
                 'spent': False,
                 'txn': x['txn']
             },
-            upsert=True)
-
-            xaddress = str(P2PKHBitcoinAddress.from_pubkey(x['public_key'].decode('hex')))
-            if xaddress == address:
-                reverse_public_key = x['public_key']
+            upsert=True))
 
+            if not reverse_public_key:
+                xaddress = str(P2PKHBitcoinAddress.from_pubkey(x['public_key'].decode('hex')))
+                if xaddress == address:
+                    reverse_public_key = x['public_key']
 
-        if not reverse_public_key:
-            # no reverse public key means they have never even created a transaction
-            # so no need to check for spend, anything sent to them is unspent
-            if ids:
-                res = Mongo.db.unspent_cache.find({'address': address, 'spent': False, 'id': {'$in': ids}})
-            else:
-                res = Mongo.db.unspent_cache.find({'address': address, 'spent': False})
-            return res
-
-        spent = Mongo.db.blocks.aggregate([
-            {
-                "$match": {
-                    "index": {"$gt": block_height}
-                }
-            },
-            {
-                "$match": {
-                    "transactions.public_key": reverse_public_key
-                }
-            },
-            {"$unwind": "$transactions" },
-            {
-                "$project": {
-                    "_id": 0,
-                    "txn": "$transactions"
-                }
-            },
-            {
-                "$match": {
-                    "txn.public_key": reverse_public_key
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0,
-                    "public_key": "$txn.public_key",
-                    "txn": "$txn"
-                }
-            }
-        ])
-
-        ids_spent_by_me = []
-        for x in spent:
-            for i in x['txn']['inputs']:
-                Mongo.db.unspent_cache.update({
-                    'address': address,
-                    'id': i['id']
+        # no reverse public key means they have never even created a transaction
+        # so no need to check for spend, anything sent to them is unspent
+        if reverse_public_key:
+            spent = Mongo.db.blocks.aggregate([
+                {
+                    "$match": scan_range
                 },
                 {
-                    '$set': {
-                        'spent': True
+                    "$match": {
+                        "transactions.public_key": reverse_public_key
                     }
-                })
-
-        
-
-        if ids:
-            res = Mongo.db.unspent_cache.find({'address': address, 'spent': False, 'id': {'$in': ids}})
-        else:
-            res = Mongo.db.unspent_cache.find({'address': address, 'spent': False})
-        return res
+                },
+                {"$unwind": "$transactions" },
+                {
+                    "$project": {
+                        "_id": 0,
+                        "txn": "$transactions"
+                    }
+                },
+                {
+                    "$match": {
+                        "txn.public_key": reverse_public_key
+                    }
+                },
+                {
+                    "$project": {
+                        "_id": 0,
+                        "public_key": "$txn.public_key",
+                        "txn": "$txn"
+                    }
+                }
+            ])
 
-        
+            for x in spent:
+                for i in x['txn']['inputs']:
+                    ops.append(UpdateOne({
+                        'address': address,
+                        'id': i['id']
+                    },
+                    {
+                        '$set': {
+                            'spent': True
+                        }
+                    }))
+
+        if ops:
+            # receipts first so a spend of something received in the same range finds its row
+            Mongo.db.unspent_cache.bulk_write(ops, ordered=True)
+        Mongo.db.unspent_cache_state.update({'address': address}, {
+            'address': address,
+            'height': scan_height,
+            'public_key': reverse_public_key
+        }, upsert=True)
 
     @classmethod
     def get_transactions(cls, raw=False, skip=None):
@@ -280,6 +303,7 @@ class BU(object):  # Blockchain Utilities
                     return transaction
 
     @classmethod
+    @single_flight
     def get_transactions_by_rid(cls, selector, rid=False, raw=False, returnheight=True, bulletin_secret=None):
         #selectors is old code before we got an RID by sorting the bulletin secrets
         from block import Block
@@ -374,6 +398,7 @@ class BU(object):  # Blockchain Utilities
         return transactions
 
     @classmethod
+    @single_flight
     def get_friend_requests(cls, rids):
         if not isinstance(rids, list):
             rids = [rids, ]
@@ -441,6 +466,7 @@ class BU(object):  # Blockchain Utilities
                 yield x['txn']
 
     @classmethod
+    @single_flight
     def get_sent_friend_requests(cls, rids):
 
         if not isinstance(rids, list):
@@ -504,6 +530,7 @@ class BU(object):  # Blockchain Utilities
             yield x['txn']
 
     @classmethod
+    @single_flight
     def get_messages(cls, rids):
 
         if not isinstance(rids, list):
@@ -570,6 +597,7 @@ class BU(object):  # Blockchain Utilities
             yield x['txn']
 
     @classmethod
+    @single_flight
     def get_posts(cls, rids):
         from crypt import Crypt
 
@@ -697,21 +725,288 @@ class BU(object):  # Blockchain Utilities
     @classmethod
     def get_transaction_by_id(cls, id, instance=False):
         from transaction import Transaction, Input, Crypt
-        res = Mongo.db.blocks.find({"transactions.id": id})
-        if res.count():
-            for block in res:
+        txn = None
+        entry = Mongo.db.transaction_index.find_one({'id': id})
+        if entry:
+            # only the one transaction comes back from the block
+            block = Mongo.db.blocks.find_one({'hash': entry['hash']}, {'transactions': {'$slice': [entry['position'], 1]}})
+            if block and block['transactions'] and block['transactions'][0]['id'] == id:
+                txn = block['transactions'][0]
+        if not txn:
+            txn = cls.get_transactions_by_ids([id]).get(id)
+        if txn and instance:
+            return Transaction.from_dict(txn)
+        return txn
+
+    @classmethod
+    def get_transactions_by_ids(cls, ids, instance=False):
+        # txid -> transaction dict for every id found in the chain, one transaction_index
+        # query and one blocks query however many ids are asked for
+        from transaction import Transaction, Input, Crypt
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        positions = {}
+        for entry in Mongo.db.transaction_index.find({'id': {'$in': ids}}):
+            positions.setdefault(entry['hash'], {})[entry['position']] = entry['id']
+        txns = {}
+        if positions:
+            for block in Mongo.db.blocks.find({'hash': {'$in': positions.keys()}}, {'hash': 1, 'transactions': 1}):
+                for position, id in positions.get(block['hash'], {}).iteritems():
+                    if position < len(block['transactions']) and block['transactions'][position]['id'] == id:
+                        txns[id] = block['transactions'][position]
+
+        missing = [x for x in ids if x not in txns]
+        if missing:
+            # blocks from before the index was built
+            for block in Mongo.db.blocks.find({"transactions.id": {'$in': missing}}, {'transactions': 1}):
                 for txn in block['transactions']:
-                    if txn['id'] == id:
-                        if instance:
-                            return Transaction.from_dict(txn)
-                        else:
-                            return txn
-        else:
-            # fix for bug when unspent cache returns an input 
-            # that has been removed from the chain
-            Mongo.db.unspent_cache.remove({})
+                    if txn['id'] in missing and txn['id'] not in txns:
+                        txns[txn['id']] = txn
+            gone = [x for x in missing if x not in txns]
+            if gone:
+                # the unspent cache can still hold transactions from blocks
+                # that have since been removed from the chain
+                Mongo.db.unspent_cache.remove({'id': {'$in': gone}}, multi=True)
+
+        if instance:
+            return dict([(id, Transaction.from_dict(txn)) for id, txn in txns.iteritems()])
+        return txns
+
+    @classmethod
+    def connect_block(cls, block):
+        # called with the block dict once it has been written to blocks,
+        # keeps the collections derived from the chain in step with it
+        cls.index_transactions(block)
+        cls.set_chain_work(block)
+        cls.connect_utxos(block)
+
+    @classmethod
+    def disconnect_block(cls, block):
+        # called with the block dict before it is removed from blocks
+        cls.disconnect_utxos(block)
+        Mongo.db.transaction_index.remove({'hash': block['hash']}, multi=True)
+        Mongo.db.chain_work.remove({'hash': block['hash']}, multi=True)
+
+    @classmethod
+    def index_transactions(cls, block):
+        Mongo.db.transaction_index.remove({'hash': block['hash']}, multi=True)
+        entries = [{
+            'id': txn['id'],
+            'index': block['index'],
+            'hash': block['hash'],
+            'position': position,
+            'public_key': txn.get('public_key'),
+            'outputs': txn.get('outputs', [])
+        } for position, txn in enumerate(block['transactions'])]
+        if entries:
+            Mongo.db.transaction_index.insert(entries)
+
+    @classmethod
+    def get_output_values(cls, txn):
+        # an outpoint is a transaction and one address it pays, worth all of its outputs to that address
+        values = {}
+        for output in txn.get('outputs', []):
+            values[output['to']] = values.get(output['to'], 0) + float(output['value'])
+        return values
+
+    @classmethod
+    def get_spends(cls, block):
+        # (input id, spending address) for every input in the block
+        spends = []
+        for txn in block['transactions']:
+            if not txn.get('inputs'):
+                continue
+            address = str(P2PKHBitcoinAddress.from_pubkey(txn['public_key'].decode('hex')))
+            spends.extend([(x['id'], address) for x in txn['inputs']])
+        return spends
+
+    @classmethod
+    def connect_utxos(cls, block):
+        # every output goes in before any input comes out, so a spend of an output
+        # made in the same block is removed whatever order the transactions are in
+        ops = []
+        created = []
+        created_values = {}
+        changes = {}
+        for txn in block['transactions']:
+            for address, value in cls.get_output_values(txn).iteritems():
+                created.append([txn['id'], address])
+                created_values[(txn['id'], address)] = value
+                cls.add_balance_change(changes, address, value, 1)
+                ops.append(ReplaceOne({'id': txn['id'], 'address': address}, {
+                    'id': txn['id'],
+                    'address': address,
+                    'value': value,
+                    'index': block['index'],
+                    'hash': block['hash']
+                }, upsert=True))
+        spends = cls.get_spends(block)
+        for id, address in spends:
+            ops.append(DeleteOne({'id': id, 'address': address}))
+            if (id, address) in created_values:
+                # paid and spent in this same block
+                cls.add_balance_change(changes, address, -created_values.pop((id, address)), -1)
+
+        # the undo record is everything a disconnect needs to put back exactly what this block changed
+        spent = []
+        if spends:
+            spent = [x for x in Mongo.db.utxos.find({'$or': [{'id': id, 'address': address} for id, address in spends]}, {'_id': 0})]
+        for utxo in spent:
+            cls.add_balance_change(changes, utxo['address'], -utxo['value'], -1)
+        Mongo.db.block_undo.update({'hash': block['hash']}, {
+            'hash': block['hash'],
+            'index': block['index'],
+            'created': created,
+            'spent': spent,
+            'spends': [list(x) for x in spends]
+        }, upsert=True)
+        if ops:
+            Mongo.db.utxos.bulk_write(ops, ordered=True)
+        cls.apply_balance_changes(changes)
+
+    @classmethod
+    def disconnect_utxos(cls, block):
+        undo = Mongo.db.block_undo.find_one({'hash': block['hash']})
+        if not undo:
+            undo = cls.get_undo(block)
+        changes = {}
+        for utxo in Mongo.db.utxos.find({'hash': block['hash']}, {'address': 1, 'value': 1}):
+            cls.add_balance_change(changes, utxo['address'], -utxo['value'], -1)
+        ops = [DeleteMany({'hash': block['hash']})]
+        # an outpoint whose own block has already gone must not come back
+        live = set()
+        if undo['spent']:
+            live = set([x['hash'] for x in Mongo.db.blocks.find({'hash': {'$in': list(set([x['hash'] for x in undo['spent']]))}}, {'hash': 1})])
+        for utxo in undo['spent']:
+            if utxo['hash'] not in live:
+                continue
+            ops.append(ReplaceOne({'id': utxo['id'], 'address': utxo['address']}, utxo, upsert=True))
+            cls.add_balance_change(changes, utxo['address'], utxo['value'], 1)
+        Mongo.db.utxos.bulk_write(ops, ordered=True)
+        cls.apply_balance_changes(changes)
+
+        # cached wallet rows for what this block paid go, and what it spent is unspent again
+        ops = []
+        if undo['created']:
+            ops.append(DeleteMany({'$or': [{'id': id, 'address': address} for id, address in undo['created']]}))
+        for id, address in undo['spends']:
+            ops.append(UpdateMany({'id': id, 'address': address}, {'$set': {'spent': False}}))
+        if ops:
+            Mongo.db.unspent_cache.bulk_write(ops, ordered=True)
+        # every address that had scanned this height has to scan its replacement
+        Mongo.db.unspent_cache_state.update({'height': {'$gte': block['index']}}, {'$set': {'height': block['index'] - 1}}, multi=True)
+        Mongo.db.block_undo.remove({'hash': block['hash']})
+
+    @classmethod
+    def add_balance_change(cls, changes, address, value, count):
+        # kept in whole satoshis, adding and taking away the same floats forever would drift
+        change = changes.setdefault(address, {'satoshis': 0, 'utxo_count': 0})
+        change['satoshis'] += int(round(value * 100000000))
+        change['utxo_count'] += count
+
+    @classmethod
+    def apply_balance_changes(cls, changes):
+        ops = [
+            UpdateOne({'address': address}, {'$inc': change}, upsert=True)
+            for address, change in changes.iteritems()
+        ]
+        if ops:
+            Mongo.db.balances.bulk_write(ops, ordered=False)
+
+    @classmethod
+    def get_undo(cls, block):
+        # for blocks connected before undo records were kept, worked out from transaction_index instead
+        created = []
+        for txn in block['transactions']:
+            created.extend([[txn['id'], address] for address in cls.get_output_values(txn)])
+        spends = cls.get_spends(block)
+        spent = []
+        if spends:
+            entries = {}
+            for entry in Mongo.db.transaction_index.find({'id': {'$in': [x[0] for x in spends]}, 'hash': {'$ne': block['hash']}}):
+                entries[entry['id']] = entry
+            for id, address in spends:
+                entry = entries.get(id)
+                value = cls.get_output_values(entry).get(address) if entry else None
+                if value is None:
+                    continue
+                spent.append({
+                    'id': id,
+                    'address': address,
+                    'value': value,
+                    'index': entry['index'],
+                    'hash': entry['hash']
+                })
+        return {
+            'created': created,
+            'spent': spent,
+            'spends': [list(x) for x in spends]
+        }
+
+    @classmethod
+    def ensure_chain_indexes(cls):
+        # chains from before utxos was kept (or with balances still kept as floats) are
+        # indexed once, spend checks depend on it
+        if Mongo.db.blocks.find_one() and not (
+            Mongo.db.utxos.find_one() and
+            Mongo.db.balances.find_one() and
+            not Mongo.db.balances.find_one({'satoshis': {'$exists': False}})
+        ):
+            print 'building chain indexes, this only happens once'
+            cls.rebuild_chain_indexes()
+
+    @classmethod
+    def get_block_work(cls, block_hash):
+        # the lower the hash the more work it took, the measure Blockchain.get_difficulty uses
+        return cls.max_target - int(block_hash, 16)
+
+    @classmethod
+    def get_chain_work(cls, block_hash):
+        # total work of the chain ending in this block, None for a block we don't have
+        record = Mongo.db.chain_work.find_one({'hash': block_hash})
+        if record:
+            return int(record['chain_work'], 16)
+        block = Mongo.db.blocks.find_one({'hash': block_hash}, {'index': 1, 'hash': 1, 'prevHash': 1})
+        if not block:
             return None
-    
+        return cls.set_chain_work(block)
+
+    @classmethod
+    def set_chain_work(cls, block):
+        # stored as hex, the totals outgrow what bson can hold as a number
+        work = cls.get_block_work(block['hash'])
+        if block['index'] > 0:
+            prev = Mongo.db.chain_work.find_one({'hash': block['prevHash']})
+            if prev:
+                chain_work = int(prev['chain_work'], 16) + work
+            else:
+                # nothing recorded below us yet, sum the chain once and build on it from here
+                chain_work = work + sum([
+                    cls.get_block_work(x['hash'])
+                    for x in Mongo.db.blocks.find({'index': {'$lt': block['index']}}, {'hash': 1})
+                ])
+        else:
+            chain_work = work
+        Mongo.db.chain_work.update({'hash': block['hash']}, {
+            'hash': block['hash'],
+            'index': block['index'],
+            'chain_work': format(chain_work, 'x')
+        }, upsert=True)
+        return chain_work
+
+    @classmethod
+    def rebuild_chain_indexes(cls):
+        Mongo.db.transaction_index.remove({})
+        Mongo.db.chain_work.remove({})
+        Mongo.db.utxos.remove({})
+        Mongo.db.block_undo.remove({})
+        Mongo.db.balances.remove({})
+        Mongo.db.unspent_cache.remove({})
+        Mongo.db.unspent_cache_state.remove({})
+        for block in cls.get_blocks():
+            cls.connect_block(block)
+
     @classmethod
     def get_version_for_height(cls, height):
         if int(height) <= 14484:
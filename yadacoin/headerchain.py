@@ -0,0 +1,70 @@
+from mongo import Mongo
+
+
+class BlockHeader(object):
+    # everything consensus and retargeting look at, without the transactions
+    __slots__ = ('index', 'hash', 'prev_hash', 'time', 'target', 'special_min')
+
+    def __init__(self, index, block_hash, prev_hash, block_time, target, special_min):
+        self.index = index
+        self.hash = block_hash
+        self.prev_hash = prev_hash
+        self.time = block_time
+        self.target = target
+        self.special_min = special_min
+
+    @classmethod
+    def from_dict(cls, block):
+        return cls(
+            block.get('index'),
+            block.get('hash'),
+            block.get('prevHash'),
+            block.get('time'),
+            int(block.get('target'), 16),
+            block.get('special_min')
+        )
+
+    @classmethod
+    def from_block(cls, block):
+        return cls(
+            block.index,
+            block.hash,
+            block.prev_hash,
+            block.time,
+            block.target,
+            block.special_min
+        )
+
+
+class HeaderChain(object):
+    # blocks[i] is the header at height i, which is all BlockFactory.get_target
+    # and Consensus need from a Blockchain. Chain work lives in BU's chain_work collection
+    def __init__(self, headers=None):
+        self.blocks = sorted(headers or [], key=lambda x: x.index)
+
+    @classmethod
+    def from_mongo(cls, query=None):
+        fields = {'_id': 0, 'index': 1, 'hash': 1, 'prevHash': 1, 'time': 1, 'target': 1, 'special_min': 1}
+        return cls([BlockHeader.from_dict(x) for x in Mongo.db.blocks.find(query or {}, fields)])
+
+    def append(self, header):
+        self.blocks.append(header)
+
+    def put(self, header):
+        # mirrors Mongo.db.blocks.update({'index': ...}, upsert=True)
+        if header.index == len(self.blocks):
+            self.append(header)
+        elif header.index < len(self.blocks):
+            self.blocks[header.index] = header
+        else:
+            raise IndexError('header chain does not reach height %s' % header.index)
+
+    def fork(self, index, headers):
+        # a chain sharing our headers up to index and continuing with headers
+        chain = HeaderChain()
+        chain.blocks = self.blocks[:index + 1] + sorted(headers, key=lambda x: x.index)
+        return chain
+
+    def truncate(self, index):
+        # drops every header above index
+        del self.blocks[index + 1:]
@@ -0,0 +1,45 @@
+import hashlib
+
+
+class MerkleTree(object):
+    def __init__(self, txn_hashes):
+        # levels[0] is the sorted transaction hashes and levels[-1] holds only the root.
+        # Hashes are paired left to right and an odd one out is hashed on its own,
+        # there is always at least one level above the transactions.
+        self.levels = [list(txn_hashes)]
+        while 1:
+            hashes = self.levels[-1]
+            self.levels.append([
+                self.hash_pair(hashes[i], hashes[i + 1] if i + 1 < len(hashes) else '')
+                for i in range(0, len(hashes), 2)
+            ])
+            if len(self.levels[-1]) <= 1:
+                break
+        self.root = self.levels[-1][0]
+
+    @classmethod
+    def hash_pair(cls, left, right):
+        return hashlib.sha256(left + right).digest().encode('hex')
+
+    def get_proof(self, txn_hash):
+        # the sibling needed at each level on the way up, and which side it goes on
+        position = self.levels[0].index(txn_hash)
+        proof = []
+        for hashes in self.levels[:-1]:
+            sibling = position ^ 1
+            proof.append({
+                'hash': hashes[sibling] if sibling < len(hashes) else '',
+                'side': 'left' if sibling < position else 'right'
+            })
+            position /= 2
+        return proof
+
+    @classmethod
+    def verify_proof(cls, txn_hash, proof, merkle_root):
+        lhash = txn_hash
+        for step in proof:
+            if step['side'] == 'left':
+                lhash = cls.hash_pair(step['hash'], lhash)
+            else:
+                lhash = cls.hash_pair(lhash, step['hash'])
+        return lhash == merkle_root
@@ -1,4 +1,8 @@
+import sys
 import time
+import hashlib
+import threading
+import multiprocessing
 import requests
 from bitcoin.wallet import P2PKHBitcoinAddress
 from config import Config
@@ -6,6 +10,7 @@ from mongo import Mongo
 from peers import Peers
 from block import Block, BlockFactory
 from blockchain import Blockchain
+from headerchain import HeaderChain
 from blockchainutils import BU
 from transaction import Transaction, MissingInputTransactionException, \
     InvalidTransactionException, \
@@ -13,16 +18,41 @@ from transaction import Transaction, MissingInputTransactionException, \
 
 
 class MiningPool(object):
+    nonce_range_size = 1000000  # for miners that have not reported a hashrate yet
+    min_nonce_range_size = 10000
+    max_nonce_range_size = 100000000
+    nonce_range_time = 30  # seconds we aim for one range to take a miner's core
+    nonce_range_expire_time = 120  # minimum seconds before an unfinished range is handed out again
+    miners = {}
+    job_id = 0
+    tip_id = 0
+    templates = {}
+    template_check_time = 1  # seconds between checks for a new tip or mempool change
+    template_mempool_time = 10  # minimum age of a template before a mempool change replaces it
+    max_templates = 10  # templates on the current tip that still accept shares
+    max_block_time = 600
+    rebuild_requested = threading.Event()
+    max_target = BU.max_target
+    share_interval = 10  # seconds we aim for between shares from one address
+    share_retarget_time = 60  # seconds
+    share_retarget_count = 30  # shares
+    share_targets = {}
+    min_share_difficulty = 10000  # hashes, keeps slow miners from submitting every nonce
+
     @classmethod
     def pool_init(cls, config):
         Config.from_dict(config)
         Mongo.init()
         Peers.init()
-        max_block_time = 600
+        cls.set_template(cls.build_template())
+
+    @classmethod
+    def build_template(cls):
+        max_block_time = cls.max_block_time
         block = BU.get_latest_block()
         if block:
             block = Block.from_dict(block)
-            cls.height = block.index + 1
+            height = block.index + 1
         else:
             genesis_block = BlockFactory.get_genesis_block()
             genesis_block.save()
@@ -33,51 +63,307 @@ class MiningPool(object):
                 'index': 0
                 })
             block = Block.from_dict(BU.get_latest_block())
-            cls.height = block.index
+            height = block.index
 
         try:
-            if cls.height > 0:
+            if height > 0:
                 last_time = block.time
             special_min = False
             max_target = 0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
-            if cls.height > 0:
+            if height > 0:
                 time_elapsed_since_last_block = int(time.time()) - int(last_time)
 
                 # special min case
                 if time_elapsed_since_last_block > max_block_time:
                     target = max_target
                     special_min = True
-            cls.target = BlockFactory.get_target(cls.height, last_time, block, Blockchain([x for x in BU.get_blocks()]))
+            target = BlockFactory.get_target(height, last_time, block, HeaderChain.from_mongo())
 
-            cls.block_factory = BlockFactory(
+            block_factory = BlockFactory(
                 transactions=MiningPool.get_pending_transactions(),
                 public_key=Config.public_key,
                 private_key=Config.private_key,
-                index=cls.height,
-                version=BU.get_version_for_height(cls.height))
-            cls.block_factory.block.special_min = special_min
-            cls.block_factory.block.target = cls.target
-            cls.block_factory.header = BlockFactory.generate_header(cls.block_factory.block)
+                index=height,
+                version=BU.get_version_for_height(height))
+            block_factory.block.special_min = special_min
+            block_factory.block.target = target
+            block_factory.header = BlockFactory.generate_header(block_factory.block)
+            block_factory.compiled_header = BlockFactory.compile_header(block_factory.header)
+            block_factory.template_id = hashlib.sha256(block_factory.header).digest().encode('hex')
+            block_factory.template_saved = False
+            block_factory.tip_hash = block.hash
+            block_factory.tip_time = block.time
+            block_factory.mempool_state = cls.get_mempool_state()
+            block_factory.built = time.time()
+            block_factory.start_nonce = 0
+            block_factory.outstanding = {}
+            block_factory.share_targets = {}
+            block_factory.reclaimed = []
+            block_factory.reclaimed_checked = time.time()
         except Exception as e:
             raise
-    
+        return block_factory
+
     @classmethod
-    def nonce_generator(cls):
-        Mongo.init()
-        latest_block_index = BU.get_latest_block()['index']
+    def set_template(cls, block_factory):
+        cls.job_id += 1
+        block_factory.job_id = cls.job_id
+        current = getattr(cls, 'block_factory', None)
+        if current and current.tip_hash == block_factory.tip_hash:
+            # same tip, work handed out on the older templates is still good
+            block_factory.tip_id = current.tip_id
+            templates = dict(cls.templates)
+            for job_id in sorted(templates)[:-cls.max_templates + 1]:
+                del templates[job_id]
+        else:
+            cls.tip_id += 1
+            block_factory.tip_id = cls.tip_id
+            templates = {}
+        templates[block_factory.job_id] = block_factory
+        cls.templates = templates
+        # a single assignment, requests see either the old template or the new one
+        cls.block_factory = block_factory
+
+    @classmethod
+    def get_template(cls, job_id=None):
+        if job_id is None:
+            return getattr(cls, 'block_factory', None)
+        return cls.templates.get(job_id)
+
+    @classmethod
+    def get_mempool_state(cls):
+        latest = Mongo.db.miner_transactions.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+        return Mongo.db.miner_transactions.count(), latest['_id'] if latest else None
+
+    @classmethod
+    def template_is_stale(cls):
+        block_factory = cls.block_factory
+        latest_block = BU.get_latest_block()
+        if not latest_block or latest_block['hash'] != block_factory.tip_hash:
+            return True
+        if not block_factory.block.special_min and int(time.time()) - int(block_factory.tip_time) > cls.max_block_time:
+            # the special min case has kicked in since this template was built
+            return True
+        if time.time() - block_factory.built < cls.template_mempool_time:
+            return False
+        return cls.get_mempool_state() != block_factory.mempool_state
+
+    @classmethod
+    def request_rebuild(cls):
+        cls.rebuild_requested.set()
+
+    @classmethod
+    def template_builder(cls):
+        # prepares the next template off the request path and swaps it in when ready
         while 1:
-            next_latest_block_index = BU.get_latest_block()['index']
-            if latest_block_index < next_latest_block_index:
-                latest_block_index = next_latest_block_index
-                start_nonce = 0
-                cls.pool_init(Config.to_dict())
+            cls.rebuild_requested.wait(cls.template_check_time)
+            cls.rebuild_requested.clear()
+            try:
+                if cls.template_is_stale():
+                    cls.set_template(cls.build_template())
+            except Exception as e:
+                print 'template build failed:', e
+
+    @classmethod
+    def start_template_builder(cls, config):
+        if getattr(cls, 'builder', None):
+            return
+        cls.pool_init(config)
+        cls.builder = threading.Thread(target=cls.template_builder)
+        cls.builder.daemon = True
+        cls.builder.start()
+
+    @classmethod
+    def get_job(cls, address=None, hashrate=None, done=None):
+        if not hasattr(cls, 'block_factory'):
+            cls.start_template_builder(Config.to_dict())
+        if address:
+            cls.update_miner(address, hashrate)
+            for job_id, start_nonce in done or []:
+                cls.complete_nonce_range(job_id, address, start_nonce)
+        return cls.next_job(address)
+
+    @classmethod
+    def update_miner(cls, address, hashrate=None):
+        miner = cls.miners.setdefault(address, {'hashrate': None})
+        if hashrate:
+            miner['hashrate'] = float(hashrate)
+        miner['seen'] = time.time()
+
+    @classmethod
+    def get_nonce_range_size(cls, address):
+        miner = cls.miners.get(address) if address else None
+        if not miner or not miner['hashrate']:
+            return cls.nonce_range_size
+        size = int(miner['hashrate'] * cls.nonce_range_time)
+        return min(max(size, cls.min_nonce_range_size), cls.max_nonce_range_size)
+
+    @classmethod
+    def get_nonce_range(cls, block_factory, address):
+        size = cls.get_nonce_range_size(address)
+        cls.reclaim_nonce_ranges(block_factory)
+        if block_factory.reclaimed:
+            # finish what missing miners left behind before opening up new nonces
+            start, end = block_factory.reclaimed.pop(0)
+            if end - start > size:
+                block_factory.reclaimed.insert(0, [start + size, end])
+                end = start + size
+            nonces = [start, end]
+        else:
+            nonces = [block_factory.start_nonce, block_factory.start_nonce + size]
+            block_factory.start_nonce += size
+        expected = float(nonces[1] - nonces[0]) / size * cls.nonce_range_time
+        block_factory.outstanding[(address, nonces[0])] = {
+            'nonces': nonces,
+            'expires': time.time() + max(expected * 4, cls.nonce_range_expire_time)
+        }
+        return nonces
+
+    @classmethod
+    def complete_nonce_range(cls, job_id, address, start_nonce):
+        block_factory = cls.templates.get(job_id)
+        if block_factory:
+            block_factory.outstanding.pop((address, start_nonce), None)
+
+    @classmethod
+    def reclaim_nonce_ranges(cls, block_factory):
+        now = time.time()
+        if now - block_factory.reclaimed_checked < 1:
+            return
+        block_factory.reclaimed_checked = now
+        for key, nonce_range in block_factory.outstanding.items():
+            if nonce_range['expires'] < now:
+                del block_factory.outstanding[key]
+                block_factory.reclaimed.append(nonce_range['nonces'])
+
+    @classmethod
+    def next_job(cls, address=None):
+        block_factory = cls.block_factory
+        nonces = cls.get_nonce_range(block_factory, address)
+        job = {
+            'job_id': block_factory.job_id,
+            'tip_id': block_factory.tip_id,
+            'nonces': nonces,
+            'target': block_factory.block.target,
+            'special_min': block_factory.block.special_min,
+            'header': block_factory.header
+        }
+        if address:
+            job['share_target'] = cls.get_share_target(address)
+            # shares are judged against what this job was issued with, the miner's target
+            # may well have moved by the time they come in
+            block_factory.share_targets.setdefault(address, set()).add(job['share_target'])
+        return job
+
+    @classmethod
+    def get_issued_share_target(cls, block_factory, address, share_target=None):
+        issued = block_factory.share_targets.get(address)
+        if not issued:
+            return cls.get_share_target(address)
+        if share_target in issued:
+            return share_target
+        # a miner that doesn't say which of its ranges the share came from gets the easiest one
+        return max(issued)
+
+    @classmethod
+    def get_share_target(cls, address):
+        vardiff = cls.share_targets.get(address)
+        if not vardiff:
+            # new miners start at about one share per interval for the hashrate they
+            # reported, or per default sized range, and settle from there
+            miner = cls.miners.get(address)
+            if miner and miner['hashrate']:
+                difficulty = max(miner['hashrate'] * cls.share_interval, cls.min_share_difficulty)
             else:
-                try:
-                    start_nonce += 1000000
-                except:
-                    start_nonce = 0
-            MiningPool.index = latest_block_index
-            yield [start_nonce, start_nonce + 1000000]
+                difficulty = cls.nonce_range_size
+            vardiff = {
+                'target': cls.clamp_share_target(int(cls.max_target / difficulty)),
+                'shares': 0,
+                'since': time.time()
+            }
+            cls.share_targets[address] = vardiff
+        cls.retarget_shares(vardiff)
+        return vardiff['target']
+
+    @classmethod
+    def record_share(cls, address):
+        vardiff = cls.share_targets.get(address)
+        if not vardiff:
+            cls.get_share_target(address)
+            vardiff = cls.share_targets[address]
+        vardiff['shares'] += 1
+        cls.retarget_shares(vardiff)
+
+    @classmethod
+    def retarget_shares(cls, vardiff):
+        elapsed = time.time() - vardiff['since']
+        if elapsed < cls.share_retarget_time and vardiff['shares'] < cls.share_retarget_count:
+            return
+        expected = elapsed / cls.share_interval
+        # more shares than expected means the target is too easy, so it comes down
+        ratio = min(max(vardiff['shares'] / expected, 0.25), 4.0)
+        vardiff['target'] = cls.clamp_share_target(int(vardiff['target'] / ratio))
+        vardiff['shares'] = 0
+        vardiff['since'] = time.time()
+
+    @classmethod
+    def clamp_share_target(cls, target):
+        if target > cls.max_target / cls.min_share_difficulty:
+            target = cls.max_target / cls.min_share_difficulty
+        if hasattr(cls, 'block_factory') and target < cls.block_factory.block.target:
+            # anything harder than the network target is a block, not a share
+            target = cls.block_factory.block.target
+        return target
+
+    @classmethod
+    def verify_share(cls, block_factory, nonce, lhash):
+        # only the nonce differs from the template we handed out, so recomputing the
+        # header hash is all a share needs. Full block verification is left for
+        # shares that also meet the network target.
+        return BlockFactory.generate_hash_from_compiled_header(block_factory.compiled_header, nonce) == lhash
+
+    @classmethod
+    def get_share_difficulty(cls, share_target):
+        return float(cls.max_target) / float(share_target)
+
+    @classmethod
+    def save_share(cls, block_factory, address, nonce, lhash, difficulty):
+        # shares only keep what differs from their template, the template itself is stored once
+        cls.save_template(block_factory)
+        return Mongo.db.shares.update({
+            'address': address,
+            'index': block_factory.block.index,
+            'hash': lhash
+        },
+        {
+            'address': address,
+            'index': block_factory.block.index,
+            'hash': lhash,
+            'nonce': nonce,
+            'difficulty': difficulty,
+            'template': block_factory.template_id
+        }, upsert=True)
+
+    @classmethod
+    def save_template(cls, block_factory):
+        if block_factory.template_saved:
+            return
+        Mongo.db.share_templates.update({
+            'id': block_factory.template_id
+        },
+        {
+            'id': block_factory.template_id,
+            'index': block_factory.block.index,
+            'block': cls.get_template_dict(block_factory.block)
+        }, upsert=True)
+        block_factory.template_saved = True
+
+    @classmethod
+    def get_template_dict(cls, block):
+        template = block.to_dict()
+        for key in ['hash', 'nonce', 'id']:
+            template.pop(key, None)
+        return template
 
     @classmethod
     def get_pending_transactions(cls):
@@ -93,9 +379,7 @@ class MiningPool(object):
                 if address in unspent_indexed:
                     unspent_ids = unspent_indexed[address]
                 else:
-                    needed_value = sum([float(x.value) for x in transaction.outputs]) + float(transaction.fee)
-                    res = BU.get_wallet_unspent_transactions(address, needed_value=needed_value)
-                    unspent_ids = [x['id'] for x in res]
+                    unspent_ids = BU.get_unspent_ids(address)
                     unspent_indexed[address] = unspent_ids
                 failed1 = False
                 failed2 = False
@@ -139,15 +423,191 @@ class MiningPool(object):
         return transaction_objs
     
     @classmethod
-    def pool_mine(cls, pool_peer, address, header, target, nonces, special_min):
-        nonce, lhash = BlockFactory.mine(header, target, nonces, special_min)
-        if nonce and lhash:
-            requests.post("http://{pool}/pool-submit".format(pool=pool_peer), json={
-                'nonce': nonce,
-                'hash': lhash,
-                'address': address
-            }, headers={'Connection':'close'})
-    
+    def job_cancelled(cls, tip_id, current_tip):
+        # current_tip is a shared multiprocessing.Value holding the tip id of the latest job
+        # the miner has seen, any other id means the chain has moved and the header is stale
+        if current_tip is None:
+            return None
+        return lambda: current_tip.value != tip_id
+
+    @classmethod
+    def pool_submit(cls, pool_peer, address, nonce, lhash, job_id=None, share_target=None):
+        requests.post("http://{pool}/pool-submit".format(pool=pool_peer), json={
+            'nonce': nonce,
+            'hash': lhash,
+            'address': address,
+            'job_id': job_id,
+            'share_target': share_target
+        }, headers={'Connection':'close'})
+
+    @classmethod
+    def pool_worker(cls, jobs, results, current_tip=None):
+        # long lived hashing process, fed jobs from /pool by the parent through a queue
+        while 1:
+            job = jobs.get()
+            if job is None:
+                return
+            job_id = job.get('job_id')
+            start = time.time()
+            # every nonce beating the share target is a share, so what we submit
+            # grows with the work done rather than with the number of ranges
+            shares = []
+            nonce, lhash = BlockFactory.mine(
+                job['header'],
+                job['target'],
+                job['nonces'],
+                job['special_min'],
+                cls.job_cancelled(job.get('tip_id'), current_tip),
+                job.get('share_target'),
+                shares
+            )
+            elapsed = time.time() - start
+            # mine stops early on a cancel or a winning nonce, the range size only says
+            # how many hashes were done when it ran to the end without finding one
+            finished = lhash and not job['special_min'] and lhash.decode('hex') >= BlockFactory.target_to_digest(job['target'])
+            if not lhash:
+                shares = []
+            elif not finished and (nonce, lhash) not in shares:
+                # a special_min block doesn't have to meet the share target
+                shares.append((nonce, lhash))
+            results.put({
+                'shares': shares,
+                'job_id': job_id,
+                'nonces': job['nonces'],
+                'share_target': job.get('share_target'),
+                # per core
+                'hashrate': (job['nonces'][1] - job['nonces'][0]) / elapsed if finished and elapsed else None
+            })
+
+    @classmethod
+    def make_solo_job(cls):
+        # template state shared with the local hashing processes, all guarded by one lock
+        return {
+            'lock': multiprocessing.Lock(),
+            'job_id': multiprocessing.RawValue('i', 0),
+            'header': multiprocessing.RawArray('c', 1024),
+            'target': multiprocessing.RawArray('c', 65),
+            'special_min': multiprocessing.RawValue('b', 0),
+            'next_nonce': multiprocessing.RawValue('L', 0)
+        }
+
+    @classmethod
+    def publish_solo_job(cls, job, block_factory, resume=False):
+        with job['lock']:
+            job['header'].value = block_factory.header
+            job['target'].value = format(block_factory.block.target, 'x')
+            job['special_min'].value = 1 if block_factory.block.special_min else 0
+            if not resume:
+                job['next_nonce'].value = 0
+            job['job_id'].value = block_factory.job_id
+
+    @classmethod
+    def solo_worker(cls, job, results):
+        # hashes whatever template the parent last published, taking nonce ranges
+        # off the shared counter and dropping them as soon as the template changes
+        while 1:
+            with job['lock']:
+                job_id = job['job_id'].value
+                if job_id:
+                    header = job['header'].value
+                    target = int(job['target'].value, 16)
+                    special_min = bool(job['special_min'].value)
+                    start = job['next_nonce'].value
+                    job['next_nonce'].value += cls.nonce_range_size
+            if not job_id:
+                time.sleep(0.1)
+                continue
+            nonce, lhash = BlockFactory.mine(
+                header,
+                target,
+                [start, start + cls.nonce_range_size],
+                special_min,
+                lambda: job['job_id'].value != job_id
+            )
+            if lhash and (int(lhash, 16) < target or special_min):
+                with job['lock']:
+                    # first find for the template wins, clearing job_id parks every
+                    # worker until the parent publishes the next one
+                    if job['job_id'].value != job_id:
+                        continue
+                    job['job_id'].value = 0
+                results.put({
+                    'job_id': job_id,
+                    'nonce': nonce,
+                    'hash': lhash
+                })
+
+    @classmethod
+    def get_solo_block(cls, result):
+        block_factory = cls.get_template(result['job_id'])
+        if not block_factory:
+            print 'solo block found on a template that has been replaced'
+            return None
+        if not cls.verify_share(block_factory, result['nonce'], result['hash']):
+            print 'solo block failed verification'
+            return None
+        block = block_factory.block
+        block.hash = result['hash']
+        block.nonce = result['nonce']
+        block.signature = BU.generate_signature(block.hash)
+        try:
+            block.verify()
+        except:
+            print 'solo block failed verification'
+            return None
+        return block
+
+    @classmethod
+    def benchmark_worker(cls, seconds, results):
+        # hashes a synthetic header shaped like a real one against an impossible target
+        header = '2' + str(int(time.time())) + '02' + '00' * 32 + '100000' + 'ff' * 32 + \
+            '{nonce}' + 'False' + str(cls.max_target) + 'ee' * 32
+        batches = [0]
+        deadline = time.time() + seconds
+        def cancelled():
+            batches[0] += 1
+            return time.time() >= deadline
+        start = time.time()
+        BlockFactory.mine(header, 0, [0, sys.maxint], False, cancelled)
+        elapsed = time.time() - start
+        # the first check happens before any hashing
+        results.put((batches[0] - 1) * BlockFactory.mine_batch_size / elapsed)
+
+    @classmethod
+    def benchmark(cls, max_cores, seconds=10):
+        results = []
+        for cores in range(1, max_cores + 1):
+            queue = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=cls.benchmark_worker, args=(seconds, queue)) for i in range(cores)]
+            for p in processes:
+                p.start()
+            hashrate = sum([queue.get() for p in processes])
+            for p in processes:
+                p.join()
+            per_core = hashrate / cores
+            results.append({
+                'cores': cores,
+                'hashrate': hashrate,
+                'per_core': per_core,
+                'efficiency': per_core / results[0]['per_core'] if results else 1.0
+            })
+            print '%s core(s): %.0f H/s total, %.0f H/s per core, %.0f%% scaling efficiency' % (
+                cores,
+                hashrate,
+                per_core,
+                results[-1]['efficiency'] * 100
+            )
+        return results
+
+    @classmethod
+    def get_benchmark_cores(cls, results):
+        # fewest cores that get within 3% of the best total, extra hyperthreads
+        # that add nothing just make the box hotter
+        best = max([x['hashrate'] for x in results])
+        for result in sorted(results, key=lambda x: x['cores']):
+            if result['hashrate'] >= best * 0.97:
+                return result['cores']
+
     @classmethod
     def broadcast_block(cls, block):
         Peers.init()
@@ -18,8 +18,9 @@ class Mongo(object):
 
         __id = IndexModel([("id", ASCENDING)], name="__id")
         __height = IndexModel([("height", ASCENDING)], name="__height")
+        __address_id = IndexModel([("address", ASCENDING), ("id", ASCENDING)], name="__address_id")
         try:
-            cls.db.unspent_cache.create_indexes([__id, __height])
+            cls.db.unspent_cache.create_indexes([__id, __height, __address_id])
         except:
             pass
 
@@ -37,4 +38,60 @@ class Mongo(object):
         try:
             cls.db.shares.create_indexes([__address, __index, __hash])
         except:
-            pass
\ No newline at end of file
+            pass
+
+        __id = IndexModel([("id", ASCENDING)], name="__id", unique=True)
+        __index = IndexModel([("index", ASCENDING)], name="__index")
+        try:
+            cls.db.share_templates.create_indexes([__id, __index])
+        except:
+            pass
+
+        __index_address = IndexModel([("index", ASCENDING), ("address", ASCENDING)], name="__index_address", unique=True)
+        try:
+            cls.db.share_totals.create_indexes([__index_address])
+        except:
+            pass
+
+        __id = IndexModel([("id", ASCENDING)], name="__id")
+        __hash = IndexModel([("hash", ASCENDING)], name="__hash")
+        __index = IndexModel([("index", ASCENDING)], name="__index")
+        try:
+            cls.db.transaction_index.create_indexes([__id, __hash, __index])
+        except:
+            pass
+
+        __hash = IndexModel([("hash", ASCENDING)], name="__hash", unique=True)
+        __index = IndexModel([("index", ASCENDING)], name="__index")
+        try:
+            cls.db.chain_work.create_indexes([__hash, __index])
+        except:
+            pass
+
+        __id_address = IndexModel([("id", ASCENDING), ("address", ASCENDING)], name="__id_address", unique=True)
+        __address = IndexModel([("address", ASCENDING)], name="__address")
+        __hash = IndexModel([("hash", ASCENDING)], name="__hash")
+        try:
+            cls.db.utxos.create_indexes([__id_address, __address, __hash])
+        except:
+            pass
+
+        __hash = IndexModel([("hash", ASCENDING)], name="__hash", unique=True)
+        __index = IndexModel([("index", ASCENDING)], name="__index")
+        try:
+            cls.db.block_undo.create_indexes([__hash, __index])
+        except:
+            pass
+
+        __address = IndexModel([("address", ASCENDING)], name="__address", unique=True)
+        try:
+            cls.db.balances.create_indexes([__address])
+        except:
+            pass
+
+        __address = IndexModel([("address", ASCENDING)], name="__address", unique=True)
+        __height = IndexModel([("height", ASCENDING)], name="__height")
+        try:
+            cls.db.unspent_cache_state.create_indexes([__address, __height])
+        except:
+            pass
@@ -0,0 +1,84 @@
+import copy
+import inspect
+import itertools
+import functools
+
+import gevent
+from gevent.event import AsyncResult
+
+
+class Flight(object):
+    def __init__(self):
+        self.owner = gevent.getcurrent()
+        self.result = AsyncResult()
+        self.waiters = 0
+
+
+def single_flight(func):
+    # identical calls made while one is already running on the same hub wait for it
+    # instead of repeating the same queries. Nothing is kept once it returns.
+    flights = {}
+
+    def join(key):
+        # returns (flight, leader), no flight means the running call is further up our
+        # own stack and waiting on it would never return
+        flight = flights.get(key)
+        if flight is None:
+            flight = flights[key] = Flight()
+            return flight, True
+        if flight.owner is gevent.getcurrent():
+            return None, False
+        flight.waiters += 1
+        return flight, False
+
+    def get_key(args, kwargs):
+        # greenlets on different hubs (OS threads) can't wait on each other
+        return gevent.get_hub(), repr((args[1:], sorted(kwargs.items())))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = get_key(args, kwargs)
+        flight, leader = join(key)
+        if not flight:
+            return func(*args, **kwargs)
+        if not leader:
+            return copy.deepcopy(flight.result.get())
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            del flights[key]
+            if flight.waiters:
+                flight.result.set_exception(e)
+            raise
+        del flights[key]
+        if flight.waiters:
+            # the caller is free to change what it gets back, the waiters copy from this one
+            flight.result.set(copy.deepcopy(result))
+        return result
+
+    @functools.wraps(func)
+    def generator_wrapper(*args, **kwargs):
+        # the work worth sharing (catching the caches up with the chain) is done before
+        # the first item comes out, so the flight only lasts that long and the waiters
+        # then read the warmed caches themselves rather than copies of our items
+        key = get_key(args, kwargs)
+        flight, leader = join(key)
+        if flight and not leader:
+            flight.result.wait()
+            flight = None
+
+        items = func(*args, **kwargs)
+        if flight:
+            try:
+                first = list(itertools.islice(items, 1))
+            finally:
+                del flights[key]
+                flight.result.set()
+            if not first:
+                return
+            yield first[0]
+        for x in items:
+            yield x
+
+    return generator_wrapper if inspect.isgeneratorfunction(func) else wrapper
@@ -112,9 +112,12 @@ class TransactionFactory(object):
         else:
             needed_inputs = []
             done = False
+            input_txns = BU.get_transactions_by_ids([x.id for x in inputs], instance=True)
             for y in inputs:
                 print y.id
-                txn = BU.get_transaction_by_id(y.id, instance=True)
+                txn = input_txns.get(y.id)
+                if not txn:
+                    continue
                 for txn_output in txn.outputs:
                     if txn_output.to == my_address:
                         input_sum += txn_output.value
@@ -145,8 +148,9 @@ class TransactionFactory(object):
 
     def get_input_hashes(self):
         input_hashes = []
+        input_txns = BU.get_transactions_by_ids([x.id for x in self.inputs], instance=True)
         for x in self.inputs:
-            txn = BU.get_transaction_by_id(x.id, instance=True)
+            txn = input_txns[x.id]
             input_hashes.append(str(txn.transaction_signature))
 
         return ''.join(sorted(input_hashes, key=str.lower))
@@ -248,29 +252,21 @@ class Transaction(object):
             coinbase=txn.get('coinbase', '')
         )
 
-    def verify(self):
+    def verify(self, check_signature=True):
         verify_hash = self.generate_hash()
         address = P2PKHBitcoinAddress.from_pubkey(self.public_key.decode('hex'))
 
         if verify_hash != self.hash:
             raise InvalidTransactionException("transaction is invalid")
 
-        try:
-            result = verify_signature(base64.b64decode(self.transaction_signature), self.hash, self.public_key.decode('hex'))
-            if not result:
-                raise
-        except:
-            try:
-                result = VerifyMessage(address, BitcoinMessage(self.hash, magic=''), self.transaction_signature)
-                if not result:
-                    raise
-            except:
-                raise InvalidTransactionSignatureException("transaction signature did not verify")
+        if check_signature and not TU.verify_signature(self.hash, self.transaction_signature, self.public_key):
+            raise InvalidTransactionSignatureException("transaction signature did not verify")
 
         # verify spend
         total_input = 0
+        input_txns = BU.get_transactions_by_ids([x.id for x in self.inputs], instance=True)
         for txn in self.inputs:
-            txn_input = Transaction.from_dict(BU.get_transaction_by_id(txn.id))
+            txn_input = input_txns[txn.id]
             for output in txn_input.outputs:
                 if str(output.to) == str(address):
                     total_input += float(output.value)
@@ -302,8 +298,9 @@ class Transaction(object):
 
     def get_input_hashes(self):
         input_hashes = []
+        input_txns = BU.get_transactions_by_ids([x.id for x in self.inputs], instance=True)
         for x in self.inputs:
-            txn = BU.get_transaction_by_id(x.id, instance=True)
+            txn = input_txns.get(x.id)
             if not txn:
                 raise MissingInputTransactionException("This transaction is not in the blockchain.")
             input_hashes.append(str(txn.transaction_signature))
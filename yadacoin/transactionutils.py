@@ -5,24 +5,30 @@ import base64
 import time
 import random
 import sys
+import threading
 
 from io import BytesIO
+from collections import OrderedDict
 from uuid import uuid4
 from ecdsa import SECP256k1, SigningKey
 from ecdsa.util import randrange_from_seed__trytryagain
 from Crypto.Cipher import AES
 from pbkdf2 import PBKDF2
-from bitcoin.wallet import CBitcoinSecret
+from bitcoin.wallet import CBitcoinSecret, P2PKHBitcoinAddress
 from bitcoin.signmessage import BitcoinMessage, VerifyMessage, SignMessage
 from crypt import Crypt
 from coincurve.keys import PrivateKey
 from coincurve._libsecp256k1 import ffi
+from coincurve.utils import verify_signature
 from eccsnacks.curve25519 import scalarmult, scalarmult_base
 from config import Config
 from mongo import Mongo
 
 
 class TU(object):  # Transaction Utilities
+    verified_signatures = OrderedDict()  # (message, signature, public_key) we have already verified
+    max_verified_signatures = 100000
+    verified_signatures_lock = threading.Lock()
 
     @classmethod
     def hash(cls, message):
@@ -42,6 +48,47 @@ class TU(object):  # Transaction Utilities
         signature = key.sign(message, custom_nonce=(ffi.NULL, x))
         return base64.b64encode(signature)
 
+    @classmethod
+    def verify_signature(cls, message, signature, public_key):
+        if cls.signature_verified(message, signature, public_key):
+            return True
+        if not cls.check_signature(message, signature, public_key):
+            return False
+        cls.add_verified_signature(message, signature, public_key)
+        return True
+
+    @classmethod
+    def signature_verified(cls, message, signature, public_key):
+        key = (message, signature, public_key)
+        with cls.verified_signatures_lock:
+            if key not in cls.verified_signatures:
+                return False
+            # most recently used goes to the back so it is evicted last
+            cls.verified_signatures[key] = cls.verified_signatures.pop(key)
+            return True
+
+    @classmethod
+    def add_verified_signature(cls, message, signature, public_key):
+        # only successes are remembered, a bad signature has to be rechecked every time
+        with cls.verified_signatures_lock:
+            cls.verified_signatures[(message, signature, public_key)] = True
+            while len(cls.verified_signatures) > cls.max_verified_signatures:
+                cls.verified_signatures.popitem(last=False)
+
+    @classmethod
+    def check_signature(cls, message, signature, public_key):
+        # coincurve signatures first, then the older bitcoin signmessage format
+        try:
+            if verify_signature(base64.b64decode(signature), message, public_key.decode('hex')):
+                return True
+        except:
+            pass
+        try:
+            address = P2PKHBitcoinAddress.from_pubkey(public_key.decode('hex'))
+            return bool(VerifyMessage(address, BitcoinMessage(message, magic=''), signature))
+        except:
+            return False
+
     @classmethod
     def generate_rid(cls, bulletin_secret):
         if Config.get_bulletin_secret() == bulletin_secret: